@@ -0,0 +1,183 @@
+import time
+import asyncio
+import logging
+
+from contextlib import asynccontextmanager
+
+from custom_exceptions import ServiceUnavailable
+
+logger = logging.getLogger('cmstore-bot')
+
+CIRCUIT_STATES = {'closed': 0, 'half_open': 1, 'open': 2}
+
+
+class CircuitBreaker:
+    """Circuit breaker with a bulkhead for one operation of an external service.
+
+    After `failure_threshold` failures in a row the circuit opens and calls
+    fail at once with ServiceUnavailable for `reset_timeout` seconds. Then
+    one probe call is let through: success closes the circuit, failure opens
+    it again. At most `max_concurrency` calls run at the same time, a call
+    that waits for a slot longer than `acquire_timeout` seconds fails too.
+    """
+
+    def __init__(self, name, failure_threshold=5, reset_timeout=30, max_concurrency=5,
+                 acquire_timeout=2, errors=(Exception,), on_open=None, on_close=None):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.max_concurrency = max_concurrency
+        self.acquire_timeout = acquire_timeout
+        self.errors = errors
+        self.on_open = on_open
+        self.on_close = on_close
+        self.state = 'closed'
+        self.failures = 0
+        self.opened_until = 0
+        self.probing = False
+        self.in_use = 0
+        self.semaphore = asyncio.Semaphore(max_concurrency)
+        self.counters = {'calls': 0, 'failures': 0, 'rejected_open': 0, 'rejected_busy': 0, 'opened': 0}
+
+    def stats(self):
+        return {**self.counters, 'state': self.state, 'in_use': self.in_use}
+
+    def open(self, opened_until=None, notify=True):
+        self.state = 'open'
+        self.opened_until = opened_until or time.time() + self.reset_timeout
+        self.probing = False
+        self.counters['opened'] += 1
+        logger.warning(f'Сервис недоступен, операция {self.name} приостановлена до {time.ctime(self.opened_until)}')
+        if notify and self.on_open:
+            self.on_open(self)
+
+    def close(self):
+        self.state = 'closed'
+        self.failures = 0
+        self.probing = False
+        logger.info(f'Сервис снова доступен, операция {self.name} возобновлена')
+        if self.on_close:
+            self.on_close(self)
+
+    def allow(self):
+        if self.state == 'open':
+            if time.time() < self.opened_until:
+                return False
+            self.state = 'half_open'
+        if self.state == 'half_open':
+            if self.probing:
+                return False
+            self.probing = True
+        return True
+
+    def record_success(self):
+        self.failures = 0
+        if self.state == 'half_open':
+            self.close()
+
+    def record_failure(self):
+        self.counters['failures'] += 1
+        # запросы, начатые до открытия, не продлевают приостановку
+        if self.state == 'open':
+            return
+        self.failures += 1
+        if self.state == 'half_open' or self.failures >= self.failure_threshold:
+            self.open()
+
+    @asynccontextmanager
+    async def call(self):
+        if not self.allow():
+            self.counters['rejected_open'] += 1
+            raise ServiceUnavailable
+        probe = self.state == 'half_open'
+        try:
+            await asyncio.wait_for(self.semaphore.acquire(), self.acquire_timeout)
+        except asyncio.TimeoutError:
+            if probe:
+                self.probing = False
+            self.counters['rejected_busy'] += 1
+            raise ServiceUnavailable
+        self.counters['calls'] += 1
+        self.in_use += 1
+        try:
+            yield
+        except self.errors:
+            self.record_failure()
+            raise
+        except BaseException:
+            # отмена задачи не говорит о состоянии сервиса
+            if probe:
+                self.probing = False
+            raise
+        else:
+            self.record_success()
+        finally:
+            self.in_use -= 1
+            self.semaphore.release()
+
+
+class CircuitBreakers:
+    """Circuit breakers of service operations shared by bot processes through Redis.
+
+    A process that opens a circuit stores the time it reopens in Redis, other
+    processes read the circuits once in `sync_interval` seconds in background,
+    so calls never wait for Redis.
+    """
+
+    def __init__(self, redis=None, prefix='circuit', sync_interval=1, **breaker_options):
+        self.redis = redis
+        self.prefix = prefix
+        self.sync_interval = sync_interval
+        self.breaker_options = breaker_options
+        self.breakers = {}
+        self.pending_writes = set()
+
+    def get_key(self, name):
+        return f'{self.prefix}:{name}'
+
+    def get(self, name):
+        if name not in self.breakers:
+            self.breakers[name] = CircuitBreaker(
+                name, on_open=self.publish_open, on_close=self.publish_close, **self.breaker_options
+            )
+        return self.breakers[name]
+
+    def stats(self):
+        return {name: breaker.stats() for name, breaker in self.breakers.items()}
+
+    def write(self, coroutine):
+        task = asyncio.create_task(coroutine)
+        self.pending_writes.add(task)
+        task.add_done_callback(self.pending_writes.discard)
+        task.add_done_callback(lambda task: task.cancelled() or task.exception())
+
+    def publish_open(self, breaker):
+        if self.redis:
+            self.write(self.redis.set(
+                self.get_key(breaker.name), breaker.opened_until, px=int(breaker.reset_timeout * 1000)
+            ))
+
+    def publish_close(self, breaker):
+        if self.redis:
+            self.write(self.redis.delete(self.get_key(breaker.name)))
+
+    async def sync(self):
+        names = list(self.breakers)
+        if not names or not self.redis:
+            return
+        opened_until_values = await self.redis.mget([self.get_key(name) for name in names])
+        now = time.time()
+        for name, opened_until in zip(names, opened_until_values):
+            breaker = self.breakers[name]
+            if opened_until and float(opened_until) > now and breaker.state != 'open':
+                breaker.open(float(opened_until), notify=False)
+
+    async def run(self):
+        while True:
+            try:
+                await asyncio.sleep(self.sync_interval)
+                await self.sync()
+            except asyncio.CancelledError:
+                raise
+            except Exception as error:
+                logger.error(f'Ошибка синхронизации состояния сервисов: {error}')
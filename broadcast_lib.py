@@ -0,0 +1,382 @@
+"""Broadcasts to registered participants.
+
+Chats are added to the participants set on registration. Participants
+registered before the set appeared are imported once with
+
+    $ python broadcast_lib.py import --file chat_ids.txt
+
+which also collects chats from the registration journal, the funnel and
+the SMS delivery queue.
+"""
+import re
+import json
+import time
+import uuid
+import asyncio
+import logging
+import argparse
+import aioredis
+
+from pathlib import Path
+from environs import Env
+from aiogram.utils.exceptions import CantParseEntities, ChatNotFound, Unauthorized, TelegramAPIError
+
+from journal_lib import RegistrationJournal
+from notify_rollbar import report_exc_info
+from outbound_lib import outbound_priority, PRIORITY_BACKGROUND
+
+logger = logging.getLogger('cmstore-bot')
+
+PARTICIPANTS_KEY = 'participants'
+BROADCAST_RESULTS = ('sent', 'failed', 'blocked')
+
+# Выдает рассылку процессу, если она не завершена и ее аренда другим процессом истекла.
+# KEYS: хеш рассылки. ARGV: процесс, время, срок аренды.
+CLAIM_SCRIPT = '''
+local status = redis.call('HGET', KEYS[1], 'status')
+if status ~= 'pending' and status ~= 'running' then
+    return 0
+end
+local owner = redis.call('HGET', KEYS[1], 'owner')
+local lease_until = tonumber(redis.call('HGET', KEYS[1], 'lease_until') or 0)
+if owner and owner ~= ARGV[1] and lease_until > tonumber(ARGV[2]) then
+    return 0
+end
+redis.call('HSET', KEYS[1], 'owner', ARGV[1], 'lease_until', tonumber(ARGV[2]) + tonumber(ARGV[3]), 'status', 'running')
+redis.call('HSETNX', KEYS[1], 'started_at', ARGV[2])
+return 1
+'''
+
+# Сохраняет позицию курсора после пачки получателей и продлевает аренду.
+# Возвращает новое состояние рассылки или 'lost', если рассылку забрал другой процесс.
+# KEYS: хеш рассылки, множество активных рассылок. ARGV: процесс, время, срок аренды, курсор, последняя ли пачка.
+CHECKPOINT_SCRIPT = '''
+if redis.call('HGET', KEYS[1], 'owner') ~= ARGV[1] then
+    return 'lost'
+end
+local status = redis.call('HGET', KEYS[1], 'status')
+if status ~= 'running' then
+    return status
+end
+redis.call('HSET', KEYS[1], 'cursor', ARGV[4], 'lease_until', tonumber(ARGV[2]) + tonumber(ARGV[3]))
+if ARGV[5] == '1' then
+    redis.call('HSET', KEYS[1], 'status', 'done', 'finished_at', ARGV[2])
+    redis.call('SREM', KEYS[2], KEYS[1])
+    return 'done'
+end
+return 'running'
+'''
+
+# Продлевает аренду, пока рассылка принадлежит процессу. Возвращает состояние рассылки или 'lost'.
+# KEYS: хеш рассылки. ARGV: процесс, время, срок аренды.
+RENEW_LEASE_SCRIPT = '''
+if redis.call('HGET', KEYS[1], 'owner') ~= ARGV[1] then
+    return 'lost'
+end
+local status = redis.call('HGET', KEYS[1], 'status')
+if status == 'running' then
+    redis.call('HSET', KEYS[1], 'lease_until', tonumber(ARGV[2]) + tonumber(ARGV[3]))
+end
+return status
+'''
+
+
+async def add_participant(redis, chat_id):
+    await redis.sadd(PARTICIPANTS_KEY, chat_id)
+
+
+class BroadcastStore:
+    """Broadcast jobs in Redis: a hash per job with its text, state, cursor and counters."""
+
+    def __init__(self, redis, prefix='broadcast'):
+        self.redis = redis
+        self.prefix = prefix
+        self.jobs_key = f'{prefix}:jobs'
+        self.active_key = f'{prefix}:active'
+
+    def get_key(self, broadcast_id):
+        return f'{self.prefix}:{broadcast_id}'
+
+    async def create(self, text, parse_mode=None):
+        broadcast_id = uuid.uuid4().hex[:12]
+        now = time.time()
+        async with self.redis.pipeline(transaction=True) as pipe:
+            pipe.hset(self.get_key(broadcast_id), mapping={
+                'id': broadcast_id,
+                'text': text,
+                'parse_mode': parse_mode or '',
+                'status': 'pending',
+                'created_at': now,
+                'cursor': 0,
+                'sent': 0,
+                'failed': 0,
+                'blocked': 0,
+            })
+            pipe.scard(PARTICIPANTS_KEY)
+            pipe.zadd(self.jobs_key, {broadcast_id: now})
+            pipe.sadd(self.active_key, self.get_key(broadcast_id))
+            _, total, *_ = await pipe.execute()
+        await self.redis.hset(self.get_key(broadcast_id), 'total', total)
+        return broadcast_id
+
+    async def get(self, broadcast_id):
+        """Job state with throughput and expected time left, None for unknown id."""
+        job = await self.redis.hgetall(self.get_key(broadcast_id))
+        if not job:
+            return None
+        for field in ('total', 'sent', 'failed', 'blocked'):
+            job[field] = int(job.get(field, 0))
+        for field in ('created_at', 'started_at', 'finished_at', 'lease_until'):
+            if field in job:
+                job[field] = float(job[field])
+        processed = job['sent'] + job['failed'] + job['blocked']
+        if 'started_at' in job:
+            elapsed = job.get('finished_at', time.time()) - job['started_at']
+            job['per_second'] = round(processed / elapsed, 2) if elapsed > 0 else None
+            left = max(job['total'] - processed, 0)
+            job['seconds_left'] = round(left / job['per_second']) if job['per_second'] else None
+        return job
+
+    async def list(self, limit=20):
+        broadcast_ids = await self.redis.zrevrange(self.jobs_key, 0, limit - 1)
+        return [job for job in [await self.get(broadcast_id) for broadcast_id in broadcast_ids] if job]
+
+    async def stop(self, key, status, **fields):
+        async with self.redis.pipeline(transaction=True) as pipe:
+            pipe.hset(key, mapping={'status': status, 'finished_at': time.time(), **fields})
+            pipe.srem(self.active_key, key)
+            await pipe.execute()
+
+    async def cancel(self, broadcast_id):
+        key = self.get_key(broadcast_id)
+        if await self.redis.hget(key, 'status') not in ('pending', 'running'):
+            return False
+        await self.stop(key, 'cancelled')
+        return True
+
+
+class BroadcastWorker:
+    """Sends broadcast jobs to chats from the participants set.
+
+    Every bot process runs a worker, a job is leased by one of them and taken
+    over by another one if the process stops. The lease is renewed in
+    background while messages are sent, and sending stops as soon as the job
+    is cancelled or taken over. Recipients are read with SSCAN in batches and
+    the cursor is saved after every batch. Every handled chat is remembered
+    with the job counters, so a resumed job sends again only the messages
+    that were in flight when the process stopped. The first message of a job
+    is sent alone: if Telegram cannot parse its markup the job is rejected.
+    Messages go through the outbound scheduler with background priority, at
+    most `concurrency` at the same time.
+    """
+
+    def __init__(self, store, bot, concurrency=10, batch_size=100, lease=60, poll_interval=5,
+                 ttl=30 * 24 * 60 * 60):
+        self.store = store
+        self.redis = store.redis
+        self.bot = bot
+        self.concurrency = concurrency
+        self.batch_size = batch_size
+        self.lease = lease
+        self.poll_interval = poll_interval
+        self.ttl = ttl
+        self.owner = uuid.uuid4().hex
+        self.counters = dict.fromkeys(BROADCAST_RESULTS, 0)
+
+    def stats(self):
+        return dict(self.counters)
+
+    async def claim(self):
+        for key in await self.redis.smembers(self.store.active_key):
+            if await self.redis.eval(CLAIM_SCRIPT, 1, key, self.owner, time.time(), self.lease):
+                return key
+        return None
+
+    async def send(self, key, chat_id, job, semaphore):
+        async with semaphore:
+            try:
+                await self.bot.send_message(chat_id, job['text'], parse_mode=job['parse_mode'] or None)
+                result = 'sent'
+            except CantParseEntities:
+                raise
+            except (Unauthorized, ChatNotFound):
+                result = 'blocked'
+            except TelegramAPIError as error:
+                logger.warning(f'Ошибка отправки рассылки в чат {chat_id}: {error}')
+                result = 'failed'
+            # чат отмечается сразу, чтобы после сбоя повторно отправить только незавершенные сообщения
+            async with self.redis.pipeline(transaction=False) as pipe:
+                pipe.sadd(f'{key}:done', chat_id)
+                pipe.hincrby(key, result, 1)
+                await pipe.execute()
+            self.counters[result] += 1
+            return result
+
+    async def keep_lease(self, key, sending):
+        """Renew the lease while `sending` runs, cancel it when the job is no longer ours."""
+        while True:
+            await asyncio.sleep(self.lease / 3)
+            try:
+                status = await self.redis.eval(RENEW_LEASE_SCRIPT, 1, key, self.owner, time.time(), self.lease)
+            except Exception as error:
+                logger.error(f'Ошибка продления аренды рассылки: {error}')
+                continue
+            if status != 'running':
+                logger.info(f'Рассылка {key}: {status}, отправка остановлена')
+                sending.cancel()
+                return
+
+    async def send_batch(self, key, chat_ids, job, semaphore, probed):
+        if not probed:
+            # пока ни одно сообщение не дошло, текст может оказаться с ошибкой разметки,
+            # поэтому сообщения отправляются по одному
+            while chat_ids and not probed:
+                probed = await self.send(key, chat_ids.pop(0), job, semaphore) == 'sent'
+        results = await asyncio.gather(
+            *[self.send(key, chat_id, job, semaphore) for chat_id in chat_ids], return_exceptions=True
+        )
+        errors = [result for result in results if isinstance(result, BaseException)]
+        if errors:
+            # позиция не сохраняется, необработанные чаты пачки отправит следующая попытка
+            raise errors[0]
+        return probed
+
+    async def run_job(self, key):
+        # сообщения рассылки уступают очередь ответам пользователям
+        outbound_priority.set(PRIORITY_BACKGROUND)
+        job = await self.redis.hgetall(key)
+        done_key = f'{key}:done'
+        await self.redis.expire(key, self.ttl)
+        semaphore = asyncio.Semaphore(self.concurrency)
+        cursor = int(job['cursor'])
+        probed = int(job['sent']) > 0
+        while True:
+            next_cursor, chat_ids = await self.redis.sscan(PARTICIPANTS_KEY, cursor, count=self.batch_size)
+            # SSCAN может вернуть чат повторно, а после сбоя пачка читается заново
+            async with self.redis.pipeline(transaction=False) as pipe:
+                for chat_id in chat_ids:
+                    pipe.sismember(done_key, chat_id)
+                handled = await pipe.execute()
+            chat_ids = [chat_id for chat_id, is_handled in zip(chat_ids, handled) if not is_handled]
+            sending = asyncio.ensure_future(self.send_batch(key, chat_ids, job, semaphore, probed))
+            heartbeat = asyncio.create_task(self.keep_lease(key, sending))
+            try:
+                probed = await sending
+            except CantParseEntities as error:
+                logger.error(f'Рассылка {job["id"]} отклонена: {error}')
+                await self.store.stop(key, 'rejected', error=str(error))
+                return
+            except asyncio.CancelledError:
+                if not heartbeat.done():
+                    raise
+                return
+            finally:
+                heartbeat.cancel()
+            await self.redis.expire(done_key, self.ttl)
+            status = await self.redis.eval(
+                CHECKPOINT_SCRIPT, 2, key, self.store.active_key,
+                self.owner, time.time(), self.lease, next_cursor, 1 if next_cursor == 0 else 0
+            )
+            if status != 'running':
+                logger.info(f'Рассылка {job["id"]}: {status}')
+                return
+            cursor = next_cursor
+
+    async def run(self):
+        while True:
+            try:
+                key = await self.claim()
+                if key:
+                    await self.run_job(key)
+                else:
+                    await asyncio.sleep(self.poll_interval)
+            except asyncio.CancelledError:
+                raise
+            except Exception as error:
+                logger.error(f'Ошибка рассылки: {error}')
+                report_exc_info()
+                await asyncio.sleep(self.poll_interval)
+
+
+def read_chat_ids_file(path):
+    """Chat ids from a file: one id per line or JSON lines with a `chat_id` field."""
+    chat_ids = set()
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if line.startswith('{'):
+                chat_id = json.loads(line).get('chat_id')
+            else:
+                chat_id = line.split(',', 1)[0].strip()
+            if chat_id is not None and re.fullmatch(r'-?\d+', str(chat_id)):
+                chat_ids.add(int(chat_id))
+    return chat_ids
+
+
+def read_journal_chat_ids(journal_dir):
+    """Chat ids of all registrations kept in the journal, replayed or not."""
+    chat_ids = set()
+    directories = {path.parent for path in Path(journal_dir).glob('**/*.log')}
+    for directory in directories:
+        journal = RegistrationJournal(directory)
+        position = (0, 0)
+        while True:
+            records = journal.read_records(position, limit=1000)
+            if not records:
+                break
+            chat_ids.update(record['chat_id'] for record, _ in records if record is not None)
+            position = records[-1][1]
+    return chat_ids
+
+
+async def read_redis_chat_ids(redis):
+    """Chat ids of registrations still kept by the funnel and the SMS delivery queue."""
+    chat_ids = set()
+    async for key in redis.scan_iter(match='funnel:chat:*', count=1000):
+        if await redis.hexists(key, 'finish'):
+            chat_ids.add(int(key.rsplit(':', 1)[1]))
+    for message in (await redis.hgetall('sms:messages')).values():
+        chat_id = json.loads(message).get('chat_id')
+        if chat_id is not None:
+            chat_ids.add(int(chat_id))
+    return chat_ids
+
+
+async def import_participants(redis, chat_ids, batch_size=1000):
+    chat_ids = list(chat_ids)
+    added = 0
+    for start in range(0, len(chat_ids), batch_size):
+        added += await redis.sadd(PARTICIPANTS_KEY, *chat_ids[start:start + batch_size])
+    return added
+
+
+async def run_import(args):
+    env = Env()
+    env.read_env()
+    redis = aioredis.Redis(
+        host=env.str('REDIS_HOST', 'localhost'),
+        port=env.int('REDIS_PORT', 6379),
+        db=5,
+        decode_responses=True
+    )
+    chat_ids = set()
+    for path in args.file:
+        chat_ids |= read_chat_ids_file(path)
+    chat_ids |= read_journal_chat_ids(args.journal_dir or env.str('JOURNAL_DIR', str(Path(__file__).parent / 'journal')))
+    chat_ids |= await read_redis_chat_ids(redis)
+    added = await import_participants(redis, chat_ids)
+    print(f'found chats: {len(chat_ids)}, new participants: {added}, total: {await redis.scard(PARTICIPANTS_KEY)}')
+    await redis.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Загрузка чатов участников, зарегистрированных до появления рассылок.')
+    parser.add_argument('command', choices=('import',))
+    parser.add_argument('--file', action='append', default=[],
+                        help='выгрузка chat_id: по одному в строке, csv с chat_id в первой колонке или json строки')
+    parser.add_argument('--journal-dir', help='каталог журнала регистраций, по умолчанию JOURNAL_DIR')
+    asyncio.run(run_import(parser.parse_args()))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,124 @@
+import time
+import asyncio
+
+from collections import OrderedDict
+from contextlib import suppress
+
+
+class CachedValue:
+    """Value returned by `fetch` coroutine, cached for `ttl` seconds.
+
+    An expired value is still returned while a refresh runs in the background,
+    concurrent misses share one `fetch` call and the last good value is kept
+    when `fetch` raises one of `errors`. Until the first value is fetched,
+    callers after a failed `fetch` get its error at once, and a new `fetch`
+    starts in the background at most once in `retry_interval` seconds.
+    """
+
+    def __init__(self, fetch, ttl, errors=(Exception,), retry_interval=30):
+        self.fetch = fetch
+        self.ttl = ttl
+        self.errors = errors
+        self.retry_interval = retry_interval
+        self.value = None
+        self.expires_at = 0
+        self.refreshing = None
+        self.error = None
+
+    async def get(self):
+        if self.value is None:
+            if self.error is None:
+                return await asyncio.shield(self.refresh())
+            # сервис недоступен с запуска: вызывающий сразу получает ошибку и использует значение по умолчанию
+            if time.monotonic() >= self.expires_at:
+                self.refresh()
+            raise self.error.with_traceback(None)
+        if time.monotonic() >= self.expires_at:
+            self.refresh()
+        return self.value
+
+    def refresh(self):
+        if self.refreshing is None or self.refreshing.done():
+            self.refreshing = asyncio.create_task(self._refresh())
+            # исключение фонового обновления получит тот, кто ждёт задачу, остальные его не увидят
+            self.refreshing.add_done_callback(lambda task: task.cancelled() or task.exception())
+        return self.refreshing
+
+    async def _refresh(self):
+        try:
+            value = await self.fetch()
+        except self.errors as error:
+            self.error = error
+            self.expires_at = time.monotonic() + min(self.retry_interval, self.ttl)
+            raise
+        self.value = value
+        self.error = None
+        self.expires_at = time.monotonic() + self.ttl
+        return value
+
+
+class SharedCache:
+    """In-process LRU cache with TTL in front of Redis.
+
+    Values are strings, Redis keys are `prefix:key`. Concurrent loads of one
+    key in the process share one `load` call, `None` results are not cached.
+    """
+
+    def __init__(self, redis, prefix, max_size=1024, local_ttl=60):
+        self.redis = redis
+        self.prefix = prefix
+        self.max_size = max_size
+        self.local_ttl = local_ttl
+        self.local = OrderedDict()
+        self.loading = {}
+        self.counters = {'hits': 0, 'misses': 0}
+
+    def stats(self):
+        return {**self.counters, 'local_size': len(self.local)}
+
+    def get_local(self, key):
+        with suppress(KeyError):
+            expires_at, value = self.local[key]
+            if expires_at > time.monotonic():
+                self.local.move_to_end(key)
+                return value
+            del self.local[key]
+        return None
+
+    def set_local(self, key, value, ttl):
+        self.local[key] = (time.monotonic() + min(ttl, self.local_ttl), value)
+        self.local.move_to_end(key)
+        while len(self.local) > self.max_size:
+            self.local.popitem(last=False)
+
+    async def get(self, key):
+        value = self.get_local(key)
+        if value is not None:
+            self.counters['hits'] += 1
+            return value
+        redis_key = f'{self.prefix}:{key}'
+        async with self.redis.pipeline(transaction=False) as pipe:
+            value, ttl = await pipe.get(redis_key).ttl(redis_key).execute()
+        if value is not None and ttl > 0:
+            self.set_local(key, value, ttl)
+        self.counters['hits' if value is not None else 'misses'] += 1
+        return value
+
+    async def set(self, key, value, ttl):
+        self.set_local(key, value, ttl)
+        await self.redis.set(f'{self.prefix}:{key}', value, ex=ttl)
+
+    async def get_or_load(self, key, load, get_ttl):
+        value = await self.get(key)
+        if value is not None:
+            return value
+        if key not in self.loading:
+            self.loading[key] = asyncio.create_task(self._load(key, load, get_ttl))
+            self.loading[key].add_done_callback(lambda _: self.loading.pop(key, None))
+        return await asyncio.shield(self.loading[key])
+
+    async def _load(self, key, load, get_ttl):
+        value = await load()
+        if value is not None:
+            await self.set(key, value, get_ttl(value))
+        return value
@@ -2,7 +2,9 @@ import os
 import re
 import glob
 import asks
+import anyio
 import yaml
+import asyncio
 import config
 import aiofiles
 import functools
@@ -12,15 +14,20 @@ from instabot import Bot
 from urllib.parse import unquote_plus
 from pathlib import Path
 from multiprocessing.pool import ThreadPool as Pool
+from concurrent.futures import ThreadPoolExecutor
 
 from requests import HTTPError, ConnectionError
+from metrics_lib import track_dependency
+from breaker_lib import CircuitBreakers
 from custom_exceptions import (
     RequestError,
     DocumentNotFound,
     NoActiveDrawFound,
     DocumentDoesNotMatch,
     DocumentParticipatedInDraw,
-    UnableGetCharacters
+    UnableGetCharacters,
+    AccountIsParticipat,
+    ServiceUnavailable
 )
 
 
@@ -81,6 +88,67 @@ async def read_config(param=''):
         return settings
 
 
+def unescape_text(text):
+    with suppress(SyntaxError):
+        text = eval('"' + text.replace('"', '') + '"')
+    # Иногда в зависимости от операционной системы встречается двойное экранирование
+    # управляющих последовательностей "\\\\r\\\\n\\\\t", данный код гарантирует удаление
+    # всех экранируемых символов
+    for _ in range(0, 3):
+        with suppress(SyntaxError):
+            text = eval('"' + text.replace('"', '') + '"')
+            continue
+        break
+    return text
+
+
+class ConfigCache:
+    """Keeps parsed config.yaml in memory and reloads it only when the file changes.
+
+    The introduction text is unescaped once on reload, so handlers only read
+    prepared values and never touch the file.
+    """
+
+    def __init__(self, path_to_config):
+        self.path_to_config = path_to_config
+        self.file_version = None
+        self.settings = {}
+
+    def get(self, param, default=None):
+        return self.settings.get(param, default)
+
+    async def reload(self):
+        try:
+            stat = os.stat(self.path_to_config)
+        except FileNotFoundError:
+            return False
+        file_version = (stat.st_mtime_ns, stat.st_size)
+        if file_version == self.file_version:
+            return False
+
+        with suppress(yaml.YAMLError, TypeError):
+            async with aiofiles.open(self.path_to_config, mode='r') as f:
+                content = await f.read()
+            # serv.py может не успеть дописать файл, такой конфиг перечитаем на следующей проверке
+            settings = yaml.safe_load(content)
+            if not isinstance(settings, dict):
+                raise yaml.YAMLError
+            if isinstance(settings.get('introduction_text'), str):
+                settings['introduction_text'] = unescape_text(settings['introduction_text'])
+            self.settings = settings
+            self.file_version = file_version
+            return True
+        return False
+
+    async def watch(self, interval=5):
+        while True:
+            await asyncio.sleep(interval)
+            await self.reload()
+
+
+config_cache = ConfigCache(Path(config.PROJECT_ROOT, 'config.yaml'))
+
+
 async def request_data(url, header, params):
     with suppress(asks.errors.BadStatus):
         response = await asks.get(url, headers=header, params=params)
@@ -104,14 +172,48 @@ def init_insta_bot(login, password):
     return insta_bot
 
 
-async def is_valid_insta_account(insta_name, insta_bot=None):
-    with suppress(ValueError, IndexError, asks.errors.BadStatus):
+# instabot синхронный, его запросы выполняются в отдельных потоках, чтобы не блокировать бота
+insta_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix='instagram')
+
+
+async def is_valid_insta_account(insta_name, insta_bot=None, timeout=10):
+    with suppress(ValueError, IndexError, asks.errors.BadStatus, asks.errors.ConnectivityError,
+                  asyncio.TimeoutError):
         parts_of_insta_name = re.split(r'^@', insta_name)
         nickname = parts_of_insta_name[-1]
         if insta_bot:
-            return insta_bot.get_user_id_from_username(nickname)
-        valid_insta_account = await is_valid_insta_account_without_login(nickname)
-        return valid_insta_account
+            loop = asyncio.get_running_loop()
+            async with track_dependency('instagram', 'get_user_id'):
+                user_id = await asyncio.wait_for(
+                    loop.run_in_executor(insta_executor, insta_bot.get_user_id_from_username, nickname),
+                    timeout
+                )
+            return bool(user_id)
+        async with track_dependency('instagram', 'topsearch'):
+            valid_insta_account = await asyncio.wait_for(
+                is_valid_insta_account_without_login(nickname), timeout
+            )
+        return bool(valid_insta_account)
+
+
+async def check_insta_account(cache, insta_name, insta_bot=None, timeout=10,
+                              positive_ttl=24 * 60 * 60, negative_ttl=60 * 60):
+    """Check Instagram account using shared cache of previous answers.
+
+    Returns True or False, or None if Instagram did not answer in time.
+    """
+    nickname = re.split(r'^@', insta_name)[-1].lower()
+
+    async def load():
+        is_valid = await is_valid_insta_account(nickname, insta_bot, timeout)
+        if is_valid is not None:
+            return '1' if is_valid else '0'
+
+    is_valid = await cache.get_or_load(
+        nickname, load, lambda value: positive_ttl if value == '1' else negative_ttl
+    )
+    if is_valid is not None:
+        return is_valid == '1'
 
 
 async def is_valid_insta_account_without_login(nickname):
@@ -123,55 +225,111 @@ async def is_valid_insta_account_without_login(nickname):
     return [item for item in reply['users'] if item['user']['username'] == nickname]
 
 
-async def get_document_identifiers_from_service(url, document_number):
-    response = await asks.post(url, json={"documentNumber": document_number})
-    response.raise_for_status()
-
-    document_ids = response.json()
-    if document_ids['document'] == 'not found':
-        raise DocumentNotFound
-    if document_ids['document'] == 'no active draw found':
-        raise NoActiveDrawFound
-    if document_ids['document'] == 'does not match':
-        raise DocumentDoesNotMatch
-    if document_ids['document'] == 'participates':
-        raise DocumentParticipatedInDraw
+class OneCClient:
+    """Long-lived HTTP client for the 1C service.
+
+    Keeps a bounded pool of keep-alive connections to URL_1C for the whole bot
+    process and converts asks errors into requests.HTTPError/ConnectionError,
+    which are handled by the bot. Every operation goes through its own circuit
+    breaker, which raises ServiceUnavailable while 1C is failing.
+    """
+
+    def __init__(self, url, connections=10, timeout=15, connection_timeout=5, breakers=None):
+        self.url = url
+        self.timeout = timeout
+        self.connection_timeout = connection_timeout
+        self.breakers = breakers or CircuitBreakers(errors=(HTTPError, ConnectionError))
+        # asks по умолчанию закрывает соединение после каждого запроса
+        self.session = asks.Session(
+            headers={'Connection': 'keep-alive'},
+            connections=connections
+        )
+
+    async def post(self, payload, timeout=None, operation='request'):
+        async with self.breakers.get(operation).call():
+            try:
+                async with track_dependency('1c', operation):
+                    response = await self.session.post(
+                        self.url,
+                        json=payload,
+                        timeout=timeout or self.timeout,
+                        connection_timeout=self.connection_timeout
+                    )
+                    response.raise_for_status()
+            except asks.errors.BadStatus as error:
+                raise HTTPError(str(error), response=error.response) from error
+            except (asks.errors.ConnectivityError, asks.errors.BadHttpResponse, anyio.EndOfStream,
+                    anyio.BrokenResourceError, OSError) as error:
+                # соединение, закрытое сервером без ответа, asks пропускает как ошибку anyio
+                raise ConnectionError(str(error) or type(error).__name__) from error
+        return response.json()
+
+    async def close(self):
+        await self.session.close()
+
+
+DOCUMENT_ANSWER_TO_EXCEPTION = {
+    'not found': DocumentNotFound,
+    'no active draw found': NoActiveDrawFound,
+    'does not match': DocumentDoesNotMatch,
+    'participates': DocumentParticipatedInDraw,
+}
+# Ответы 1С, которые не изменятся, если пользователь повторно отправит тот же номер чека
+CACHEABLE_DOCUMENT_ANSWERS = ('not found', 'does not match', 'participates')
+
+
+async def get_document_identifiers_from_service(client, document_number, cache=None, cache_ttl=60):
+    if cache:
+        cached_answer = await cache.get(document_number)
+        if cached_answer in DOCUMENT_ANSWER_TO_EXCEPTION:
+            raise DOCUMENT_ANSWER_TO_EXCEPTION[cached_answer]
+
+    document_ids = await client.post({"documentNumber": document_number}, operation='documentNumber')
+    answer = document_ids['document']
+    if answer in DOCUMENT_ANSWER_TO_EXCEPTION:
+        if cache and cache_ttl and answer in CACHEABLE_DOCUMENT_ANSWERS:
+            await cache.set(document_number, answer, cache_ttl)
+        raise DOCUMENT_ANSWER_TO_EXCEPTION[answer]
 
     return document_ids
 
 
-async def update_users_full_name(url, document_ids, user_full_name):
-    response = await asks.post(
-        url, json={**document_ids, **{"customerName": user_full_name}}
-    )
-    response.raise_for_status()
-
+async def update_users_full_name(client, document_ids, user_full_name):
+    await client.post({**document_ids, **{"customerName": user_full_name}}, operation='customerName')
 
-async def update_users_phone(url, document_ids, user_phone):
 
-    response = await asks.post(
-        url, json={**document_ids, **{"customerTelephone": user_phone}}
+async def update_users_phone(client, document_ids, user_phone):
+    reply = await client.post(
+        {**document_ids, **{"customerTelephone": user_phone}}, operation='customerTelephone'
     )
-    response.raise_for_status()
-
-    return response.json().get('number')
+    return reply.get('number')
 
 
-async def update_users_instagram(url, document_ids, user_instagram):
-    response = await asks.post(
-        url, json={**document_ids, **{"customerInstagram": user_instagram}}
+async def update_users_instagram(client, document_ids, user_instagram):
+    reply = await client.post(
+        {**document_ids, **{"customerInstagram": user_instagram}}, operation='customerInstagram'
     )
-    response.raise_for_status()
+    return reply.get('accountUsedToday')
 
-    return response.json().get('accountUsedToday')
 
+async def commit_participant(client, document_ids, user_instagram, user_full_name, user_phone):
+    reply = await client.post({
+        **document_ids,
+        **{
+            "customerInstagram": user_instagram,
+            "customerName": user_full_name,
+            "customerTelephone": user_phone
+        }
+    }, operation='commit')
+    if reply.get('accountUsedToday'):
+        raise AccountIsParticipat
+
+    return reply.get('number')
 
-async def get_max_number_length(url):
-    with suppress(HTTPError, ConnectionError, ValueError):
-        response = await asks.post(url, json={"currentCheck": 1})
-        response.raise_for_status()
 
-        max_number_length = response.json()
-        if max_number_length:
-            return max_number_length.get('characters')
+async def get_max_number_length(client):
+    with suppress(HTTPError, ConnectionError, ValueError, ServiceUnavailable):
+        max_number_length = await client.post({"currentCheck": 1}, operation='currentCheck')
+        if max_number_length and max_number_length.get('characters'):
+            return max_number_length['characters']
     raise UnableGetCharacters
@@ -9,7 +9,37 @@ def set_bot_variables(bot, env):
     bot.data['webhook_url'] = f"{env.str('WEBHOOK_HOST', '')}{env.str('WEBHOOK_PATH', '')}"
     bot.data['webapp_host'] = env.str('WEBAPP_HOST', '0.0.0.0')
     bot.data['webapp_port'] = env.int('WEBAPP_PORT', 5000)
+    bot.data['webhook_workers'] = env.int('WEBHOOK_WORKERS', 1) if bot.data['use_webhook'] else 1
+    bot.data['metrics_port'] = env.int('METRICS_PORT', 0)
+    bot.data['metrics_host'] = env.str('METRICS_HOST', '127.0.0.1')
+    bot.data['throttle_limits'] = env.dict(
+        'THROTTLE_LIMITS', {'default': '20/10', 'waiting_for_check_number': '5/60'}
+    )
+    bot.data['throttle_ip_limit'] = env.str('THROTTLE_IP_LIMIT', '')
+    bot.data['outbound_global_limit'] = env.str('OUTBOUND_GLOBAL_LIMIT', '30/1')
+    bot.data['outbound_chat_limit'] = env.str('OUTBOUND_CHAT_LIMIT', '3/3')
+    bot.data['outbound_group_limit'] = env.str('OUTBOUND_GROUP_LIMIT', '20/60')
+    bot.data['broadcast_concurrency'] = env.int('BROADCAST_CONCURRENCY', 10)
+    bot.data['fsm_storage'] = env.str('FSM_STORAGE', 'legacy')
+    bot.data['fsm_ttl'] = env.int('FSM_TTL', 24 * 60 * 60)
+    bot.data['fsm_cache_size'] = env.int('FSM_CACHE_SIZE', 10000)
     bot.data['sms_api_id'] = env.str('SMS_API_ID', '')
+    bot.data['sms_dispatcher'] = None
     bot.data['1c_url'] = env.str('URL_1C', '')
+    bot.data['1c_connections'] = env.int('URL_1C_CONNECTIONS', 10)
+    bot.data['1c_timeout'] = env.float('URL_1C_TIMEOUT', 15)
+    bot.data['1c_failure_threshold'] = env.int('URL_1C_FAILURE_THRESHOLD', 5)
+    bot.data['1c_reset_timeout'] = env.float('URL_1C_RESET_TIMEOUT', 30)
+    bot.data['1c_bulkhead'] = env.int('URL_1C_BULKHEAD', bot.data['1c_connections'])
+    bot.data['1c_bulkhead_timeout'] = env.float('URL_1C_BULKHEAD_TIMEOUT', bot.data['1c_timeout'])
+    bot.data['deferred_commit'] = env.bool('DEFERRED_COMMIT', False)
+    bot.data['journal_dir'] = env.str('JOURNAL_DIR', os.path.join(PROJECT_ROOT, 'journal'))
+    bot.data['journal_replay_rate'] = env.float('JOURNAL_REPLAY_RATE', 5)
+    bot.data['default_max_number_length'] = env.int('DEFAULT_MAX_NUMBER_LENGTH', 5)
+    bot.data['max_number_length_ttl'] = env.int('MAX_NUMBER_LENGTH_TTL', 600)
+    bot.data['check_number_cache_ttl'] = env.int('CHECK_NUMBER_CACHE_TTL', 60)
     bot.data['chat_ids_deleted_messages'] = env.list('CHAT_IDS_DELETED_MESSAGES', '')
+    bot.data['delete_messages_delay'] = env.int('DELETE_MESSAGES_DELAY', 30)
     bot.data['insta_bot'] = None
+    bot.data['check_insta_account'] = env.bool('CHECK_INSTA_ACCOUNT', False)
+    bot.data['insta_check_timeout'] = env.float('INSTA_CHECK_TIMEOUT', 10)
@@ -11,6 +11,7 @@ SLUG_TO_EXCEPTION_TITLE = {
     'invalid_instagram_account': 'Вы ввели недействительный аккаунт инстаграмма.',
     'account_is_participat': 'Данный аккаунт уже зарегистрирован, введите другой.',
     'unable_get_characters': 'Невозможно получить максимальную длину номера чека.',
+    'service_unavailable': 'Сервис временно недоступен, попробуйте повторить через несколько минут.',
     'unknown_error': 'Неизвестная ошибка'
 }
 
@@ -106,3 +107,9 @@ class UnableGetCharacters(NotValidUserData):
 
     def __str__(self):
         return SLUG_TO_EXCEPTION_TITLE.get('unable_get_characters', str(type(self)))
+
+
+class ServiceUnavailable(NotValidUserData):
+
+    def __str__(self):
+        return SLUG_TO_EXCEPTION_TITLE.get('service_unavailable', str(type(self)))
@@ -0,0 +1,186 @@
+import time
+import asyncio
+import logging
+
+from collections import deque
+from contextlib import suppress
+
+from notify_rollbar import report_exc_info
+
+logger = logging.getLogger('cmstore-bot')
+
+FUNNEL_STEPS = ('check_number', 'insta', 'user_name', 'phone_number', 'finish')
+DURATION_BUCKETS = (5, 10, 15, 20, 30, 45, 60, 90, 120, 180, 300, 600, 1800, 3600)
+
+# Учитывает переход чата на шаг воронки. Время входа на шаги хранится в хеше чата,
+# поэтому длительность шага считается, даже если события разных процессов пришли не по порядку.
+# KEYS: хеш дня, хеш чата. ARGV: шаг, время, ttl дня, ttl чата, число шагов, шаги..., границы корзин...
+RECORD_TRANSITION_SCRIPT = '''
+local day_key, chat_key = KEYS[1], KEYS[2]
+local step, timestamp = ARGV[1], tonumber(ARGV[2])
+local steps_count = tonumber(ARGV[5])
+local steps = {}
+for i = 1, steps_count do
+    steps[i] = ARGV[5 + i]
+end
+
+local function observe(duration_step, duration)
+    local bucket = '+Inf'
+    for i = 6 + steps_count, #ARGV do
+        if duration <= tonumber(ARGV[i]) then
+            bucket = ARGV[i]
+            break
+        end
+    end
+    redis.call('HINCRBY', day_key, 'duration:' .. duration_step .. ':' .. bucket, 1)
+end
+
+local entered_at = redis.call('HGETALL', chat_key)
+local chat_steps = {}
+for i = 1, #entered_at, 2 do
+    chat_steps[entered_at[i]] = tonumber(entered_at[i + 1])
+end
+
+if step == 'cancel' then
+    local last_step, last_timestamp = nil, nil
+    for i = 1, steps_count - 1 do
+        local step_timestamp = chat_steps[steps[i]]
+        if step_timestamp and step_timestamp <= timestamp and (not last_timestamp or step_timestamp >= last_timestamp) then
+            last_step, last_timestamp = steps[i], step_timestamp
+        end
+    end
+    local finished_at = chat_steps[steps[steps_count]]
+    if last_step and not (finished_at and finished_at >= last_timestamp) then
+        redis.call('HINCRBY', day_key, 'cancel:' .. last_step, 1)
+        redis.call('EXPIRE', day_key, ARGV[3])
+    end
+    return 0
+end
+
+redis.call('HINCRBY', day_key, 'entered:' .. step, 1)
+redis.call('EXPIRE', day_key, ARGV[3])
+redis.call('HSET', chat_key, step, timestamp)
+redis.call('EXPIRE', chat_key, ARGV[4])
+
+for i = 1, steps_count do
+    if steps[i] == step then
+        local previous_timestamp = i > 1 and chat_steps[steps[i - 1]]
+        if previous_timestamp and previous_timestamp <= timestamp then
+            observe(steps[i - 1], timestamp - previous_timestamp)
+        end
+        local next_timestamp = i < steps_count and chat_steps[steps[i + 1]]
+        if next_timestamp and next_timestamp >= timestamp then
+            observe(step, next_timestamp - timestamp)
+        end
+    end
+end
+return 1
+'''
+
+
+def estimate_percentile(bucket_counts, percent):
+    """Estimate percentile from cumulative histogram buckets by linear interpolation."""
+    total = bucket_counts[-1][1]
+    if not total:
+        return None
+    rank = total * percent / 100
+    lower_bound, lower_count = 0, 0
+    for upper_bound, count in bucket_counts:
+        if count >= rank:
+            if upper_bound == float('inf'):
+                return lower_bound
+            if count == lower_count:
+                return upper_bound
+            return lower_bound + (upper_bound - lower_bound) * (rank - lower_count) / (count - lower_count)
+        lower_bound, lower_count = upper_bound, count
+
+
+class FunnelRecorder:
+    """Records ConversationSteps transitions into per-day Redis counters and histograms.
+
+    Handlers only put transitions into an in-memory buffer, a background task
+    writes them with one pipeline per flush, so the conversation does not wait
+    for additional Redis requests.
+    """
+
+    def __init__(self, redis, prefix='funnel', retention_days=90, chat_ttl=24 * 60 * 60,
+                 flush_interval=1, max_buffer_size=10000):
+        self.redis = redis
+        self.prefix = prefix
+        self.retention = retention_days * 24 * 60 * 60
+        self.chat_ttl = chat_ttl
+        self.flush_interval = flush_interval
+        self.max_buffer_size = max_buffer_size
+        self.transitions = deque()
+        self.counters = {'recorded': 0, 'dropped': 0, 'flushed': 0}
+
+    @staticmethod
+    def get_day(timestamp=None):
+        return time.strftime('%Y-%m-%d', time.localtime(timestamp))
+
+    def get_day_key(self, day):
+        return f'{self.prefix}:day:{day}'
+
+    def stats(self):
+        return {**self.counters, 'queue_depth': len(self.transitions)}
+
+    def record(self, chat_id, step):
+        """Remember that the chat entered the funnel step or cancelled the conversation."""
+        if len(self.transitions) >= self.max_buffer_size:
+            self.counters['dropped'] += 1
+            return
+        self.transitions.append((chat_id, step, time.time()))
+        self.counters['recorded'] += 1
+
+    async def flush(self):
+        while self.transitions:
+            transitions = [self.transitions.popleft() for _ in range(min(500, len(self.transitions)))]
+            async with self.redis.pipeline(transaction=False) as pipe:
+                for chat_id, step, timestamp in transitions:
+                    pipe.eval(
+                        RECORD_TRANSITION_SCRIPT, 2,
+                        self.get_day_key(self.get_day(timestamp)), f'{self.prefix}:chat:{chat_id}',
+                        step, timestamp, self.retention, self.chat_ttl,
+                        len(FUNNEL_STEPS), *FUNNEL_STEPS, *DURATION_BUCKETS
+                    )
+                await pipe.execute()
+            self.counters['flushed'] += len(transitions)
+
+    async def run(self):
+        while True:
+            try:
+                await asyncio.sleep(self.flush_interval)
+                await self.flush()
+            except asyncio.CancelledError:
+                raise
+            except Exception as error:
+                logger.error(f'Ошибка записи воронки: {error}')
+                report_exc_info()
+
+    async def stop(self):
+        with suppress(Exception):
+            await self.flush()
+
+    async def get_report(self, day):
+        """Conversion and step duration percentiles of the day."""
+        fields = await self.redis.hgetall(self.get_day_key(day))
+        entered = {step: int(fields.get(f'entered:{step}', 0)) for step in FUNNEL_STEPS}
+        started = entered[FUNNEL_STEPS[0]]
+        report = {
+            'day': day,
+            'entered': entered,
+            'conversion': {step: round(count / started, 4) if started else None for step, count in entered.items()},
+            'cancelled': {step: int(fields.get(f'cancel:{step}', 0)) for step in FUNNEL_STEPS[:-1]},
+            'durations': {},
+        }
+        for step in FUNNEL_STEPS[:-1]:
+            bucket_counts, cumulative = [], 0
+            for upper_bound in (*DURATION_BUCKETS, float('inf')):
+                bucket = '+Inf' if upper_bound == float('inf') else upper_bound
+                cumulative += int(fields.get(f'duration:{step}:{bucket}', 0))
+                bucket_counts.append((upper_bound, cumulative))
+            report['durations'][step] = {
+                'count': cumulative,
+                **{f'p{percent}': estimate_percentile(bucket_counts, percent) for percent in (50, 90, 95, 99)},
+            }
+        return report
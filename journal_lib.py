@@ -0,0 +1,395 @@
+"""Append-only journal of registrations that could not be sent to 1C.
+
+Records are JSON lines with a CRC, written to numbered segment files. Appends
+are grouped and fsynced together in a separate thread, so handlers wait for
+one fsync per group instead of one per registration. Replay progress is kept
+in the `checkpoint` file of the journal directory.
+
+    $ python journal_lib.py inspect journal/worker-0
+    $ python journal_lib.py dump journal/worker-0 --pending
+    $ python journal_lib.py compact journal/worker-0
+"""
+import os
+import json
+import time
+import zlib
+import asyncio
+import logging
+import argparse
+
+from pathlib import Path
+from contextlib import suppress
+from concurrent.futures import ThreadPoolExecutor
+from requests import HTTPError, ConnectionError
+
+from custom_exceptions import ServiceUnavailable
+from notify_rollbar import report_exc_info
+
+logger = logging.getLogger('cmstore-bot')
+
+SEGMENT_SUFFIX = '.log'
+DEAD_LETTER_FILE = 'dead_letter.log'
+# Ответы 1С, после которых запрос стоит повторить: сервис перегружен или перезапускается
+TRANSIENT_STATUS_CODES = (502, 503, 504)
+
+
+def is_transient_error(error):
+    """Whether the 1C request may succeed if repeated later."""
+    if isinstance(error, HTTPError):
+        return error.response is None or error.response.status_code in TRANSIENT_STATUS_CODES
+    # таймауты asks превращаются в ConnectionError
+    return isinstance(error, (ServiceUnavailable, ConnectionError))
+
+
+def encode_record(record):
+    data = json.dumps(record, ensure_ascii=False).encode('utf-8')
+    return b'%08x %s\n' % (zlib.crc32(data), data)
+
+
+def decode_record(line):
+    """Return the record of a journal line or None if the line is damaged."""
+    with suppress(ValueError):
+        crc, data = line.rstrip(b'\n').split(b' ', 1)
+        if int(crc, 16) == zlib.crc32(data):
+            return json.loads(data)
+    return None
+
+
+class RegistrationJournal:
+
+    def __init__(self, directory, segment_size=4 * 1024 * 1024, group_commit_delay=0.005):
+        self.directory = Path(directory)
+        self.segment_size = segment_size
+        self.group_commit_delay = group_commit_delay
+        self.checkpoint_path = self.directory / 'checkpoint'
+        self.dead_letter_path = self.directory / DEAD_LETTER_FILE
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='journal')
+        self.pending = []
+        self.file = None
+        self.segment_index = None
+        self.wakeup = None
+        self.writer = None
+        self.counters = {'appended': 0, 'fsyncs': 0}
+
+    def stats(self):
+        return {**self.counters, 'pending_writes': len(self.pending)}
+
+    def get_segment_path(self, index):
+        return self.directory / f'{index:012d}{SEGMENT_SUFFIX}'
+
+    def get_segments(self):
+        if not self.directory.exists():
+            return []
+        return sorted(int(path.stem) for path in self.directory.glob(f'*{SEGMENT_SUFFIX}') if path.stem.isdigit())
+
+    def open_segment(self, index):
+        if self.file:
+            self.file.close()
+        self.segment_index = index
+        self.file = open(self.get_segment_path(index), 'ab')
+        self.fsync_directory()
+
+    def fsync_directory(self):
+        # новый файл сохранится после сбоя, только если сохранена и запись о нем в каталоге
+        directory_fd = os.open(self.directory, os.O_RDONLY)
+        try:
+            os.fsync(directory_fd)
+        finally:
+            os.close(directory_fd)
+
+    def truncate_torn_tail(self, index):
+        """Cut an unfinished last line left by a crash, so the next record starts on a new line."""
+        path = self.get_segment_path(index)
+        with open(path, 'rb+') as f:
+            size = end = f.seek(0, os.SEEK_END)
+            while end > 0:
+                start = max(0, end - 64 * 1024)
+                f.seek(start)
+                position = f.read(end - start).rfind(b'\n')
+                if position != -1:
+                    end = start + position + 1
+                    break
+                end = start
+            if end != size:
+                logger.warning(f'Удалена недописанная запись в конце {path}: {size - end} байт')
+                f.truncate(end)
+                f.flush()
+                os.fsync(f.fileno())
+
+    def start(self):
+        self.directory.mkdir(parents=True, exist_ok=True)
+        segments = self.get_segments()
+        if segments:
+            self.truncate_torn_tail(segments[-1])
+        self.open_segment(segments[-1] if segments else 0)
+        self.wakeup = asyncio.Event()
+        self.writer = asyncio.create_task(self.run_writer())
+
+    async def append(self, record):
+        """Write the record and wait until it is on disk."""
+        future = asyncio.get_running_loop().create_future()
+        self.pending.append((encode_record(record), future))
+        self.wakeup.set()
+        await future
+
+    def write_lines(self, lines):
+        if self.file is None or self.file.tell() >= self.segment_size:
+            self.open_segment(self.segment_index + 1)
+        offset = self.file.tell()
+        try:
+            self.file.write(b''.join(lines))
+            self.file.flush()
+            os.fsync(self.file.fileno())
+        except Exception:
+            self.discard_partial_write(offset)
+            raise
+
+    def discard_partial_write(self, offset):
+        # недописанная строка испортила бы следующую запись, поэтому сегмент обрезается до начала пачки
+        with suppress(Exception):
+            self.file.close()
+        self.file = None
+        try:
+            os.truncate(self.get_segment_path(self.segment_index), offset)
+            self.open_segment(self.segment_index)
+        except OSError as error:
+            # следующие записи попадут в новый сегмент, read_records пропустит недописанную строку
+            logger.error(f'Не удалось обрезать сегмент журнала после ошибки записи: {error}')
+
+    async def run_writer(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            await self.wakeup.wait()
+            # записи, пришедшие за время ожидания, сохраняются одним fsync
+            await asyncio.sleep(self.group_commit_delay)
+            self.wakeup.clear()
+            batch, self.pending = self.pending, []
+            if not batch:
+                continue
+            try:
+                await loop.run_in_executor(self.executor, self.write_lines, [line for line, _ in batch])
+            except Exception as error:
+                for _, future in batch:
+                    future.set_exception(error)
+                continue
+            self.counters['appended'] += len(batch)
+            self.counters['fsyncs'] += 1
+            for _, future in batch:
+                future.set_result(None)
+
+    async def close(self):
+        if self.writer:
+            while self.pending:
+                await asyncio.sleep(self.group_commit_delay)
+            self.writer.cancel()
+            self.writer = None
+        if self.file:
+            self.file.close()
+            self.file = None
+        self.executor.shutdown(wait=True)
+
+    def append_dead_letter(self, record):
+        with open(self.dead_letter_path, 'ab') as f:
+            f.write(encode_record(record))
+            f.flush()
+            os.fsync(f.fileno())
+
+    def count_dead_letters(self):
+        if not self.dead_letter_path.exists():
+            return 0
+        with open(self.dead_letter_path, 'rb') as f:
+            return sum(1 for _ in f)
+
+    def read_checkpoint(self):
+        with suppress(FileNotFoundError, ValueError):
+            segment_index, offset = self.checkpoint_path.read_text().split()
+            return int(segment_index), int(offset)
+        segments = self.get_segments()
+        return (segments[0] if segments else 0), 0
+
+    def write_checkpoint(self, position):
+        temporary_path = self.checkpoint_path.with_suffix('.tmp')
+        with open(temporary_path, 'w') as f:
+            f.write('%d %d' % position)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temporary_path, self.checkpoint_path)
+        self.fsync_directory()
+
+    def read_records(self, position, limit=100):
+        """Records after the position: a list of (record, position after the record).
+
+        Damaged records are skipped, reading stops at an unfinished last line.
+        """
+        records = []
+        segment_index, offset = position
+        segments = [index for index in self.get_segments() if index >= segment_index]
+        for index in segments:
+            if index != segment_index:
+                offset = 0
+            with open(self.get_segment_path(index), 'rb') as f:
+                f.seek(offset)
+                for line in f:
+                    if not line.endswith(b'\n'):
+                        # последняя строка может еще дописываться, в старых сегментах она повреждена
+                        if index == segments[-1]:
+                            return records
+                        logger.error(f'Недописанная запись журнала {self.get_segment_path(index)}:{offset}')
+                        break
+                    offset += len(line)
+                    record = decode_record(line)
+                    if record is None:
+                        logger.error(f'Поврежденная запись журнала {self.get_segment_path(index)}:{offset}')
+                        continue
+                    records.append((record, (index, offset)))
+                    if len(records) >= limit:
+                        return records
+            # если следующего сегмента нет, позиция остается в конце текущего
+            if index != segments[-1]:
+                records.append((None, (segments[segments.index(index) + 1], 0)))
+        return records
+
+    def count_pending(self):
+        count = 0
+        position = self.read_checkpoint()
+        while True:
+            records = self.read_records(position, limit=1000)
+            if not records:
+                return count
+            count += sum(1 for record, _ in records if record is not None)
+            position = records[-1][1]
+
+    def compact(self):
+        """Delete segments that are fully replayed."""
+        checkpoint_segment, _ = self.read_checkpoint()
+        removed = []
+        for index in self.get_segments():
+            if index < checkpoint_segment:
+                self.get_segment_path(index).unlink()
+                removed.append(index)
+        return removed
+
+
+class JournalReplayer:
+    """Sends journaled registrations to 1C in order at `rate` registrations per second.
+
+    `replay` coroutine raises ServiceUnavailable, HTTPError or ConnectionError
+    when the request fails. Transient failures (see `is_transient_error`) are
+    retried after `retry_interval` seconds, a record 1C rejects otherwise is
+    moved to the dead letter file of the journal, so it does not hold back
+    later registrations. Ids of replayed records are kept in Redis, so a record is not sent
+    twice if the process stops before the checkpoint is written.
+
+    Delivery is at least once: the 1C API has no idempotency key, so a record
+    whose request timed out after 1C had accepted it is sent again. `replay`
+    gets `maybe_delivered`, true when an earlier request of the record, from
+    the handler or a previous replay, may have reached 1C, so it can take
+    a refusal of a repeated registration for success.
+    """
+
+    def __init__(self, journals, replay, redis, rate=5, retry_interval=10, poll_interval=5,
+                 replayed_ttl=7 * 24 * 60 * 60):
+        self.journals = journals
+        self.replay = replay
+        self.redis = redis
+        self.rate = rate
+        self.retry_interval = retry_interval
+        self.poll_interval = poll_interval
+        self.replayed_ttl = replayed_ttl
+        self.counters = {'replayed': 0, 'skipped': 0, 'retries': 0, 'dead_letters': 0}
+
+    def stats(self):
+        return dict(self.counters)
+
+    async def replay_journal(self, journal):
+        # чтение идет в общем пуле потоков, чтобы не задерживать запись новых регистраций
+        loop = asyncio.get_running_loop()
+        position = await loop.run_in_executor(None, journal.read_checkpoint)
+        records = await loop.run_in_executor(None, journal.read_records, position)
+        for record, next_position in records:
+            if record is not None:
+                replayed_key = f'journal:replayed:{record["id"]}'
+                if await self.redis.exists(replayed_key):
+                    self.counters['skipped'] += 1
+                else:
+                    # отметка ставится до запроса: процесс может остановиться, не дождавшись ответа 1С
+                    sent_key = f'journal:sent:{record["id"]}'
+                    async with self.redis.pipeline(transaction=True) as pipe:
+                        previously_sent, _ = await pipe.get(sent_key).set(sent_key, 1, ex=self.replayed_ttl).execute()
+                    try:
+                        await self.replay(record, bool(record.get('maybe_delivered') or previously_sent))
+                    except (ServiceUnavailable, HTTPError, ConnectionError) as error:
+                        if isinstance(error, ServiceUnavailable) and not previously_sent:
+                            # запрос отклонен без обращения к 1С
+                            await self.redis.delete(sent_key)
+                        if is_transient_error(error):
+                            logger.warning(f'1С недоступна, повтор отправки регистраций из журнала: {error}')
+                            self.counters['retries'] += 1
+                            await asyncio.sleep(self.retry_interval)
+                            return False
+                        logger.error(f'1С отклонила регистрацию {record["id"]} из журнала, '
+                                     f'запись перенесена в {journal.dead_letter_path}: {error}')
+                        report_exc_info()
+                        await loop.run_in_executor(None, journal.append_dead_letter, {
+                            **record, 'error': str(error), 'failed_at': time.time()
+                        })
+                        self.counters['dead_letters'] += 1
+                    else:
+                        self.counters['replayed'] += 1
+                    await self.redis.set(replayed_key, 1, ex=self.replayed_ttl)
+                    await asyncio.sleep(1 / self.rate)
+            await loop.run_in_executor(None, journal.write_checkpoint, next_position)
+            if record is None:
+                await loop.run_in_executor(None, journal.compact)
+        return bool(records)
+
+    async def run(self):
+        while True:
+            try:
+                replayed = False
+                for journal in self.journals:
+                    replayed = await self.replay_journal(journal) or replayed
+                if not replayed:
+                    await asyncio.sleep(self.poll_interval)
+            except asyncio.CancelledError:
+                raise
+            except Exception as error:
+                logger.error(f'Ошибка отправки регистраций из журнала: {error}')
+                report_exc_info()
+                await asyncio.sleep(self.retry_interval)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Просмотр и сжатие журнала регистраций.')
+    parser.add_argument('command', choices=('inspect', 'dump', 'compact'))
+    parser.add_argument('directory', help='каталог журнала, например journal/worker-0')
+    parser.add_argument('--pending', action='store_true', help='dump: только не отправленные в 1С записи')
+    args = parser.parse_args()
+
+    journal = RegistrationJournal(args.directory)
+    if args.command == 'inspect':
+        checkpoint = journal.read_checkpoint()
+        print(f'checkpoint: segment {checkpoint[0]}, offset {checkpoint[1]}')
+        for index in journal.get_segments():
+            path = journal.get_segment_path(index)
+            records = sum(1 for _ in open(path, 'rb'))
+            print(f'{path.name}: {path.stat().st_size} bytes, {records} records')
+        print(f'pending records: {journal.count_pending()}')
+        print(f'dead letters: {journal.count_dead_letters()}')
+    elif args.command == 'dump':
+        position = journal.read_checkpoint() if args.pending else (0, 0)
+        while True:
+            records = journal.read_records(position, limit=1000)
+            if not records:
+                break
+            for record, position in records:
+                if record is not None:
+                    created_at = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(record.get('created_at', 0)))
+                    print(created_at, json.dumps(record, ensure_ascii=False))
+    else:
+        removed = journal.compact()
+        print(f'removed segments: {", ".join(map(str, removed)) or "none"}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,326 @@
+"""Load test of the registration conversation.
+
+Runs the real dispatcher with handlers from main.py against local stand-ins
+of Telegram Bot API, sms.ru and the monitoring server and the 1C simulator
+from simulator_1c.py. Every virtual user
+goes through /start and all ConversationSteps. Throughput and p50/p95/p99
+latencies are reported per conversation step and per outbound dependency.
+
+    $ python loadtest.py --users 2000 --concurrency 500
+
+Redis is required (REDIS_HOST, REDIS_PORT), the test uses a separate
+database given by --redis-db.
+"""
+import os
+import time
+import random
+import asyncio
+import argparse
+import functools
+import itertools
+import tempfile
+import uuid
+
+from collections import defaultdict
+from aiohttp import web
+
+from simulator_1c import Simulator1C, get_operation, latency_spec, load_scenario
+
+TOKEN = '123456:loadtest'
+
+
+class LatencyRecorder:
+
+    def __init__(self):
+        self.samples = defaultdict(list)
+        self.errors = defaultdict(int)
+
+    def add(self, name, duration):
+        self.samples[name].append(duration)
+
+    def timed(self, get_name, func):
+        @functools.wraps(func)
+        async def inner(*args, **kwargs):
+            name = get_name(*args, **kwargs)
+            started_at = time.perf_counter()
+            try:
+                return await func(*args, **kwargs)
+            except Exception:
+                self.errors[name] += 1
+                raise
+            finally:
+                self.add(name, time.perf_counter() - started_at)
+        return inner
+
+    @staticmethod
+    def percentile(sorted_samples, percent):
+        index = max(0, int(round(percent / 100 * len(sorted_samples))) - 1)
+        return sorted_samples[min(index, len(sorted_samples) - 1)]
+
+    def format_table(self, names):
+        lines = [f'{"":32}{"count":>8}{"errors":>8}{"p50 ms":>10}{"p95 ms":>10}{"p99 ms":>10}']
+        for name in names:
+            samples = sorted(self.samples[name])
+            if not samples:
+                continue
+            p50, p95, p99 = (self.percentile(samples, percent) * 1000 for percent in (50, 95, 99))
+            lines.append(
+                f'{name:32}{len(samples):>8}{self.errors[name]:>8}{p50:>10.1f}{p95:>10.1f}{p99:>10.1f}'
+            )
+        return '\n'.join(lines)
+
+
+def create_stand_in_app(args):
+    """Local stand-ins of Telegram Bot API, 1C, sms.ru and the monitoring server."""
+
+    app = web.Application()
+    app['last_texts'] = {}
+    app['simulator_1c'] = Simulator1C(
+        {'latency': args.onec_latency, 'characters': args.number_length},
+        scenario=load_scenario(args.onec_scenario),
+        seed=args.seed
+    )
+    message_ids = itertools.count(1)
+
+    async def handle_telegram(request):
+        method = request.match_info['method']
+        data = await request.post()
+        await asyncio.sleep(args.telegram_latency)
+        if method in ('sendMessage', 'sendPhoto'):
+            chat_id = int(data['chat_id'])
+            message_id = next(message_ids)
+            result = {
+                'message_id': message_id,
+                'date': int(time.time()),
+                'chat': {'id': chat_id, 'type': 'private'},
+            }
+            if method == 'sendPhoto':
+                result['photo'] = [{
+                    'file_id': f'photo-{message_id}', 'file_unique_id': f'photo-{message_id}',
+                    'width': 640, 'height': 480
+                }]
+            else:
+                result['text'] = data.get('text', '')
+                app['last_texts'][chat_id] = result['text']
+        elif method == 'getMe':
+            result = {'id': 1, 'is_bot': True, 'first_name': 'loadtest', 'username': 'loadtest_bot'}
+        else:
+            result = True
+        return web.json_response({'ok': True, 'result': result})
+
+    async def handle_sms(request):
+        method = request.match_info['method']
+        data = await request.post()
+        await asyncio.sleep(args.sms_latency)
+        if method == 'send':
+            phones = data['to'].split(',') if 'to' in data else [
+                key[len('multi['):-1] for key in data if key.startswith('multi[')
+            ]
+            sms = {phone: {'status': 'OK', 'status_code': 100, 'sms_id': uuid.uuid4().hex} for phone in phones}
+        else:
+            sms = {
+                sms_id: {'status': 'OK', 'status_code': 103, 'status_text': 'Сообщение доставлено'}
+                for sms_id in data['sms_id'].split(',')
+            }
+        return web.json_response({'status': 'OK', 'status_code': 100, 'sms': sms})
+
+    async def handle_monitoring(request):
+        await request.read()
+        await asyncio.sleep(args.monitoring_latency)
+        return web.json_response({})
+
+    app.router.add_post('/bot{token}/{method}', handle_telegram)
+    app.router.add_post('/1c', app['simulator_1c'].handle)
+    app.router.add_post('/sms/{method}', handle_sms)
+    app.router.add_post('/monitoring', handle_monitoring)
+    return app
+
+
+def make_update(update_id, chat_id, text):
+    from aiogram import types
+
+    message = {
+        'message_id': update_id,
+        'date': int(time.time()),
+        'chat': {'id': chat_id, 'type': 'private'},
+        'from': {'id': chat_id, 'is_bot': False, 'first_name': 'Load'},
+        'text': text,
+    }
+    if text.startswith('/'):
+        message['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(text)}]
+    return types.Update(update_id=update_id, message=message)
+
+
+def get_user_steps(user_number, number_length):
+    return [
+        ('start', '/start'),
+        ('join', 'Принять участие'),
+        ('check_number', str(user_number % 10 ** number_length).zfill(number_length)),
+        ('instagram', f'@loadtest_{user_number}'),
+        ('user_name', 'Иванов Иван Иванович'),
+        ('phone_number', f'79{user_number % 10 ** 9:09d}'),
+    ]
+
+
+async def run_load_test(args):
+    stand_in_app = create_stand_in_app(args)
+    runner = web.AppRunner(stand_in_app)
+    await runner.setup()
+    site = web.TCPSite(runner, '127.0.0.1', 0)
+    await site.start()
+    base_url = f'http://127.0.0.1:{runner.addresses[0][1]}'
+    journal_dir = tempfile.TemporaryDirectory(prefix='cmstore-journal-')
+
+    # Переменные окружения читаются модулями бота при импорте
+    os.environ.update({
+        'TG_BOT_TOKEN': TOKEN,
+        'USE_WEBHOOK': 'False',
+        'URL_1C': f'{base_url}/1c',
+        'URL_1C_CONNECTIONS': str(args.onec_connections),
+        'URL_1C_TIMEOUT': str(args.onec_timeout),
+        'SMS_API_ID': 'loadtest',
+        'SMS_API_URL': f'{base_url}/sms',
+        'MONITORING_SERVER': f'{base_url}/monitoring',
+        'DEFERRED_COMMIT': str(args.deferred_commit),
+        'CHECK_INSTA_ACCOUNT': 'False',
+        'CHAT_IDS_DELETED_MESSAGES': '',
+        # ошибки нагрузочного теста не отправляются в Rollbar
+        'ROLLBAR_TOKEN': '',
+        'JOURNAL_DIR': journal_dir.name,
+        'OUTBOUND_GLOBAL_LIMIT': args.outbound_global_limit,
+    })
+
+    import aioredis
+    import config
+    import main
+    import sms_api
+
+    from aiogram import Bot, Dispatcher
+    from aiogram.bot.api import TelegramAPIServer
+    from aiogram.contrib.fsm_storage.memory import MemoryStorage
+    from aiogram.contrib.fsm_storage.redis import RedisStorage2
+    from monitoring_lib import monitoring_shipper
+    from storage_lib import CompactRedisStorage, CachedStorage
+
+    recorder = LatencyRecorder()
+
+    class LoadTestBot(main.CMStoreBot):
+
+        async def request(self, method, data=None, files=None, **kwargs):
+            return await recorder.timed(lambda *_: f'telegram.{method}', super().request)(
+                method, data, files, **kwargs
+            )
+
+    bot = LoadTestBot(token=TOKEN, server=TelegramAPIServer.from_base(base_url))
+    config.set_bot_variables(bot, main.env)
+    bot.data['worker_index'] = 0
+    bot.data['redis'] = aioredis.Redis(
+        host=main.env.str('REDIS_HOST', 'localhost'),
+        port=main.env.int('REDIS_PORT', 6379),
+        db=args.redis_db,
+        decode_responses=True
+    )
+    if args.storage == 'redis':
+        storage = RedisStorage2(
+            host=main.env.str('REDIS_HOST', 'localhost'),
+            port=main.env.int('REDIS_PORT', 6379),
+            db=args.redis_db
+        )
+    elif args.storage == 'compact':
+        storage = CompactRedisStorage(bot.data['redis'], ttl=bot.data['fsm_ttl'])
+    else:
+        storage = MemoryStorage()
+    if bot.data['fsm_cache_size']:
+        storage = CachedStorage(storage, max_size=bot.data['fsm_cache_size'])
+    dp = Dispatcher(bot, storage=storage)
+    main.register_handlers_common(dp)
+    dp.register_errors_handler(main.errors_handler)
+    Bot.set_current(bot)
+    Dispatcher.set_current(dp)
+
+    sms_api.request_sms = recorder.timed(lambda method, *_, **__: f'sms.{method}', sms_api.request_sms)
+    monitoring_shipper.send = recorder.timed(lambda *_: 'monitoring.send', monitoring_shipper.send)
+    await main.on_startup(dp)
+    bot.data['1c_client'].post = recorder.timed(
+        lambda payload, *_, **__: f'1c.{get_operation(payload)}', bot.data['1c_client'].post
+    )
+
+    update_ids = itertools.count(1)
+    semaphore = asyncio.Semaphore(args.concurrency)
+    results = {'completed': 0, 'journaled': 0, 'failed': 0}
+
+    async def run_user(user_number):
+        await asyncio.sleep(random.uniform(0, args.ramp_up))
+        chat_id = 10 ** 9 + user_number
+        async with semaphore:
+            for step, text in get_user_steps(user_number, args.number_length):
+                started_at = time.perf_counter()
+                # как и в executor, каждое обновление обрабатывается в своей задаче со своим контекстом
+                await asyncio.create_task(dp.process_update(make_update(next(update_ids), chat_id, text)))
+                recorder.add(f'step.{step}', time.perf_counter() - started_at)
+                if args.think_time:
+                    await asyncio.sleep(random.uniform(0, 2 * args.think_time))
+        if 'Поздравляем' in stand_in_app['last_texts'].get(chat_id, ''):
+            results['completed'] += 1
+        elif stand_in_app['last_texts'].get(chat_id, '') == main.JOURNALED_REGISTRATION_TEXT:
+            results['journaled'] += 1
+        else:
+            results['failed'] += 1
+
+    started_at = time.perf_counter()
+    await asyncio.gather(*[run_user(user_number) for user_number in range(args.users)])
+    elapsed = time.perf_counter() - started_at
+
+    # Даем фоновым задачам отправить накопленные sms и события мониторинга
+    drain_until = time.monotonic() + args.drain_timeout
+    while time.monotonic() < drain_until:
+        if not await bot.data['sms_dispatcher'].outbox.size() and not monitoring_shipper.stats()['queue_depth']:
+            break
+        await asyncio.sleep(0.5)
+
+    await main.on_shutdown(dp)
+    await (await bot.get_session()).close()
+    await runner.cleanup()
+    journal_dir.cleanup()
+
+    updates = args.users * len(get_user_steps(0, args.number_length))
+    print(
+        f'Registrations: {results["completed"]} completed, {results["journaled"]} journaled, '
+        f'{results["failed"]} failed '
+        f'in {elapsed:.1f} s ({results["completed"] / elapsed:.1f} per second), '
+        f'updates: {updates} ({updates / elapsed:.1f} per second)'
+    )
+    print()
+    print(recorder.format_table([f'step.{step}' for step, _ in get_user_steps(0, args.number_length)]))
+    print()
+    print(recorder.format_table(sorted(name for name in recorder.samples if not name.startswith('step.'))))
+    print()
+    print('1C answers:', ', '.join(f'{name}: {count}' for name, count in stand_in_app['simulator_1c'].stats().items()))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Нагрузочное тестирование диалога регистрации.')
+    parser.add_argument('--users', type=int, default=1000, help='количество виртуальных пользователей')
+    parser.add_argument('--concurrency', type=int, default=200, help='одновременно активных пользователей')
+    parser.add_argument('--ramp-up', type=float, default=0, help='время запуска всех пользователей, сек')
+    parser.add_argument('--think-time', type=float, default=0, help='средняя пауза между шагами, сек')
+    parser.add_argument('--storage', choices=('memory', 'redis', 'compact'), default='memory', help='хранилище FSM')
+    parser.add_argument('--redis-db', type=int, default=15, help='база Redis для теста')
+    parser.add_argument('--deferred-commit', action='store_true', help='режим DEFERRED_COMMIT')
+    parser.add_argument('--number-length', type=int, default=6, help='длина номера чека в ответе 1С')
+    parser.add_argument('--onec-connections', type=int, default=10, help='соединений с 1С')
+    parser.add_argument('--outbound-global-limit', default='1000/1',
+                        help='ограничение отправки в Telegram, у настоящего Telegram 30/1')
+    parser.add_argument('--telegram-latency', type=float, default=0.03, help='задержка Bot API, сек')
+    parser.add_argument('--onec-latency', type=latency_spec, default='constant:0.1', help='распределение задержки 1С, см. simulator_1c.py')
+    parser.add_argument('--onec-scenario', default='healthy', help='сценарий симулятора 1С или путь к yaml файлу')
+    parser.add_argument('--onec-timeout', type=float, default=15, help='URL_1C_TIMEOUT, сек')
+    parser.add_argument('--sms-latency', type=float, default=0.2, help='задержка sms.ru, сек')
+    parser.add_argument('--monitoring-latency', type=float, default=0.02, help='задержка мониторинга, сек')
+    parser.add_argument('--seed', type=int, default=None, help='начальное значение генератора случайных чисел')
+    parser.add_argument('--drain-timeout', type=float, default=10, help='ожидание фоновых отправок, сек')
+    asyncio.run(run_load_test(parser.parse_args()))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,20 +1,22 @@
 import re
+import time
+import uuid
 import config
-import rollbar
 import asyncio
 import logging
+import aioredis
 import functools
 import multiprocessing
+import multiprocessing.connection
 
 from aiogram import Bot, Dispatcher, types
 from aiogram.dispatcher import FSMContext
 from aiogram.dispatcher.filters import Text, Filter
 from aiogram.dispatcher.filters.state import State, StatesGroup
 from aiogram.contrib.fsm_storage.redis import RedisStorage2
-from aiogram.utils.executor import start_polling, start_webhook
-from aiogram.utils.exceptions import (
-    BadRequest, MessageCantBeDeleted, MessageToDeleteNotFound
-)
+from aiogram.utils.executor import start_polling, set_webhook
+from aiohttp import web
+from aiogram.utils.exceptions import BadRequest, TelegramAPIError
 from contextlib import suppress
 from collections import defaultdict
 from environs import Env
@@ -22,14 +24,16 @@ from requests import HTTPError, ConnectionError
 from pathlib import Path
 
 from cmstore_lib import (
-    read_file,
-    read_config,
+    OneCClient,
+    config_cache,
     init_insta_bot,
+    check_insta_account,
     get_document_identifiers_from_service,
     update_users_full_name,
     update_users_phone,
     update_users_instagram,
-    get_max_number_length
+    get_max_number_length,
+    commit_participant
 )
 from custom_exceptions import (
     DocumentNotFound,
@@ -43,18 +47,55 @@ from custom_exceptions import (
     AccountIsParticipat,
     SmsApiError,
     DocumentParticipatedInDraw,
-    UnableGetCharacters
+    UnableGetCharacters,
+    ServiceUnavailable
+)
+from sms_api import handle_sms, SmsDispatcher
+from notify_rollbar import (
+    notify_rollbar, anotify_rollbar_from_context, report_exc_info, rollbar_reporter
 )
-from sms_api import handle_sms
-from notify_rollbar import notify_rollbar, anotify_rollbar_from_context
 from error_handler import errors_handler
-from monitoring_lib import handle_monitoring_log
+from monitoring_lib import handle_monitoring_log, monitoring_shipper
+from middlewares import ChatLockMiddleware, ThrottlingMiddleware, create_ip_throttling_middleware
+from storage_lib import CompactRedisStorage, CachedStorage, set_state_and_data
+from media_lib import MediaStore
+from cache_lib import CachedValue, SharedCache
+from scheduler_lib import DeletionScheduler
+from funnel_lib import FunnelRecorder
+from journal_lib import RegistrationJournal, JournalReplayer, is_transient_error
+from breaker_lib import CircuitBreakers, CIRCUIT_STATES
+from broadcast_lib import BroadcastStore, BroadcastWorker, add_participant
+from outbound_lib import OutboundScheduler, SCHEDULED_METHODS
+from metrics_lib import registry as metrics_registry, track_handler, track_dependency, start_metrics_server
 
 env = Env()
 env.read_env()
 
 logger = logging.getLogger('cmstore-bot')
-messages_for_remove = defaultdict(list)
+
+DEMO_INSTA_IMAGE = Path(config.MEDIAFILES_DIRS, 'demo_insta.jpg')
+JOURNALED_REGISTRATION_TEXT = '''
+Спасибо, Ваши данные приняты.
+Сервис регистрации сейчас перегружен, номер участника придёт отдельным сообщением и в СМС в течение нескольких минут.
+'''
+REPLAYED_ACCOUNT_IS_PARTICIPAT_TEXT = (
+    'Не удалось завершить регистрацию: аккаунт инстаграмма уже зарегистрирован. '
+    'Пройдите регистрацию заново с другим аккаунтом: /start'
+)
+
+
+class CMStoreBot(Bot):
+
+    async def request(self, method, data=None, files=None, **kwargs):
+        async def send_request():
+            async with track_dependency('telegram', method):
+                return await super(CMStoreBot, self).request(method, data, files, **kwargs)
+
+        # отправка сообщений идет через общий для всех процессов учет ограничений Telegram
+        outbound_scheduler = self.data.get('outbound_scheduler')
+        if outbound_scheduler and method in SCHEDULED_METHODS:
+            return await outbound_scheduler.send(send_request, method, data)
+        return await send_request()
 
 
 class ConversationSteps(StatesGroup):
@@ -81,7 +122,8 @@ def handle_mistakes():
         @functools.wraps(func)
         async def inner(*args, **kwargs):
             try:
-                await func(*args, **kwargs)
+                async with track_handler(func.__name__):
+                    await func(*args, **kwargs)
             except (
                 DocumentNotFound,
                 NoActiveDrawFound,
@@ -92,15 +134,16 @@ def handle_mistakes():
                 IncorrectUserInstagram,
                 InvalidInstagramAccount,
                 AccountIsParticipat,
-                DocumentParticipatedInDraw
+                DocumentParticipatedInDraw,
+                ServiceUnavailable
             ) as description:
                 await show_answer(args[0], description)
             except SmsApiError as error:
                 logger.error(f'Ошибки отправки sms: {error}')
-                rollbar.report_exc_info()
+                report_exc_info()
             except (HTTPError, ConnectionError) as error:
                 logger.error(f'Ошибка отправки http запроса в 1С: {error}')
-                rollbar.report_exc_info()
+                report_exc_info()
         return inner
     return decorator
 
@@ -111,34 +154,33 @@ def handle_delete_messages(delete=False):
         async def inner(*args, **kwargs):
             message_seq = await func(*args, **kwargs)
             async with anotify_rollbar_from_context():
-                chat_ids = args[0].bot.data['chat_ids_deleted_messages']
+                bot = args[0].bot
+                chat_ids = bot.data['chat_ids_deleted_messages']
+                messages_for_remove = defaultdict(list)
                 for message in message_seq:
                     chat_id = message['chat']['id']
                     if not str(chat_id) in chat_ids:
                         continue
                     messages_for_remove[chat_id].append(message.message_id)
 
+                deletion_scheduler = bot.data['deletion_scheduler']
                 if delete:
-                    asyncio.create_task(delete_messages(args[0].bot, args[0].chat.id))
+                    chat_id = args[0].chat.id
+                    await deletion_scheduler.schedule_chat(chat_id, messages_for_remove.pop(chat_id, []))
+                for chat_id, message_ids in messages_for_remove.items():
+                    await deletion_scheduler.add(chat_id, message_ids)
         return inner
     return decorator
 
 
-async def delete_messages(bot, chat_id):
-    await asyncio.sleep(30)
-    for message_id in messages_for_remove[chat_id]:
-        with suppress(MessageCantBeDeleted, MessageToDeleteNotFound):
-            await bot.delete_message(chat_id, message_id)
-    messages_for_remove[chat_id] = []
-
-
 @handle_delete_messages()
 @handle_monitoring_log()
 async def show_answer(message, text, image=None):
     result = [message]
     with suppress(BadRequest):  # перехват ошибки здесь позволяет вывести текст без картинки.
-        media_msg = await message.answer_photo(photo=image)
-        result.append(media_msg)
+        media_msg = await message.bot.data['media_store'].answer_photo(message, image)
+        if media_msg:
+            result.append(media_msg)
     keyboard = types.ReplyKeyboardMarkup(resize_keyboard=True, one_time_keyboard=True)
     buttons = ['Отказаться от участия']
     keyboard.add(*buttons)
@@ -177,25 +219,16 @@ async def cmd_start(message: types.Message, state: FSMContext):
     result = [message]
     await state.reset_state()
     with suppress(BadRequest):  # перехват ошибки здесь позволяет вывести текст без картинки.
-        path_image = await read_config('startup_image')
-        startup_photo = await read_file(path_image)
-        media_msg = await message.answer_photo(photo=startup_photo, reply_markup=types.ReplyKeyboardRemove())
-        result.append(media_msg)
-    startup_text = await read_config('introduction_text')
-    prepared_text = eval('"' + startup_text.replace('"', '') + '"')
-    # Иногда в зависимости от операционной системы встречается двойное экранирование
-    # управляющих последовательностей "\\\\r\\\\n\\\\t", данный код гарантирует удаление
-    # всех экранируемых символов
-    for _ in range(0, 3):
-        with suppress(SyntaxError):
-            prepared_text = eval('"' + prepared_text.replace('"', '') + '"')
-            continue
-        break
+        media_msg = await message.bot.data['media_store'].answer_photo(
+            message, config_cache.get('startup_image'), reply_markup=types.ReplyKeyboardRemove()
+        )
+        if media_msg:
+            result.append(media_msg)
     keyboard = types.ReplyKeyboardMarkup(resize_keyboard=True, one_time_keyboard=True)
     buttons = ['Принять участие']
     keyboard.add(*buttons)
     msg = await message.answer(
-        prepared_text,
+        config_cache.get('introduction_text'),
         parse_mode=types.ParseMode.MARKDOWN,
         reply_markup=keyboard
     )
@@ -204,6 +237,7 @@ async def cmd_start(message: types.Message, state: FSMContext):
 
 
 async def cmd_cancel(message: types.Message, state: FSMContext):
+    message.bot.data['funnel_recorder'].record(message.chat.id, 'cancel')
     await handle_finish(
         message, state,
         "Участие в розыгрыше отменено. Спасибо за проявленный интерес."
@@ -243,24 +277,31 @@ async def cmd_check_number_input(message: types.Message):
     await show_answer(message, 'Введите номер чека:')
     await message.delete()
     await ConversationSteps.waiting_for_check_number.set()
+    message.bot.data['funnel_recorder'].record(message.chat.id, 'check_number')
+
+
+async def save_step(state: FSMContext, next_state, **data):
+    # данные шага и переход к следующему шагу сохраняются одной записью в хранилище
+    await set_state_and_data(state.storage, chat=state.chat, user=state.user, state=next_state, data=data)
 
 
 @handle_mistakes()
 async def cmd_check_numbers_handle(message: types.Message, state: FSMContext):
     try:
-        max_number_length = await get_max_number_length(message.bot.data['1c_url'])
+        max_number_length = await message.bot.data['max_number_length'].get()
     except UnableGetCharacters:
         max_number_length = message.bot.data['default_max_number_length']
 
     if not re.match(r'''^(\d{%s})$''' % str(max_number_length), message.text):
         raise IncorrectDocumentNumber(max_number_length)
     document_ids = await get_document_identifiers_from_service(
-        message.bot.data['1c_url'], message.text
+        message.bot.data['1c_client'], message.text,
+        cache=message.bot.data['check_number_cache'],
+        cache_ttl=message.bot.data['check_number_cache_ttl']
     )
-    await state.update_data(document=document_ids)
-    img = await read_file(Path(config.MEDIAFILES_DIRS, 'demo_insta.jpg'))
-    await show_answer(message, 'Введите название своего аккаунта Instagram:', img)
-    await ConversationSteps.next()
+    await show_answer(message, 'Введите название своего аккаунта Instagram:', DEMO_INSTA_IMAGE)
+    await save_step(state, ConversationSteps.waiting_for_insta, document=document_ids)
+    message.bot.data['funnel_recorder'].record(message.chat.id, 'insta')
 
 
 @handle_mistakes()
@@ -268,26 +309,18 @@ async def cmd_user_name_handle(message: types.Message, state: FSMContext):
     if not re.match(r'''([А-ЯЁ][а-яё]+[\-\s]?){3,}''', message.text):
         raise IncorrectUserFullName
     user_full_name = message.text.lower()
-    user_data = await state.get_data()
-    await update_users_full_name(
-        message.bot.data['1c_url'], user_data['document'], user_full_name
-    )
-    await state.update_data(user_name=user_full_name)
+    if not message.bot.data['deferred_commit']:
+        user_data = await state.get_data()
+        await update_users_full_name(
+            message.bot.data['1c_client'], user_data['document'], user_full_name
+        )
     await show_answer(message, 'Введите свой номер телефона (в формате "79180000025"):')
-    await ConversationSteps.next()
+    await save_step(state, ConversationSteps.waiting_for_phone_number, user_name=user_full_name)
+    message.bot.data['funnel_recorder'].record(message.chat.id, 'phone_number')
 
 
-@handle_mistakes()
-@handle_sms()
-async def cmd_phone_number_handle(message: types.Message, state: FSMContext):
-    if not re.match(r'''^([78]?9\d{9})$''', message.text):
-        raise IncorrectUserPhone
-    user_data = await state.get_data()
-    participant_number = await update_users_phone(
-        message.bot.data['1c_url'], user_data['document'], message.text
-    )
-    await state.update_data(phone_number=message.text)
-    final_text = f'''
+def get_final_text(participant_number):
+    return f'''
 Поздравляем, Вы зарегистрированы.
 Ваш номер участника {participant_number if participant_number else ""}
 Ждём на розыгрышах 14, 23 февраля и 8 марта на странице [@clinicmobile23](https://www.instagram.com/clinicmobile23/).
@@ -295,27 +328,119 @@ async def cmd_phone_number_handle(message: types.Message, state: FSMContext):
 
 *Данное сообщение продублировано Вам в СМС.*
 '''
+
+
+async def journal_registration(message, state, user_data, error):
+    # 1С недоступна: регистрация сохраняется в журнал и будет отправлена в 1С позже
+    await message.bot.data['journal'].append({
+        'id': uuid.uuid4().hex,
+        'created_at': time.time(),
+        'chat_id': message.chat.id,
+        'deferred_commit': message.bot.data['deferred_commit'],
+        'document': user_data['document'],
+        'instagram': user_data.get('instagram'),
+        'user_name': user_data.get('user_name'),
+        'phone_number': message.text,
+        # запрос, оборванный таймаутом или ошибкой соединения, мог дойти до 1С
+        'maybe_delivered': not isinstance(error, ServiceUnavailable),
+    })
+    message.bot.data['funnel_recorder'].record(message.chat.id, 'finish')
+    await add_participant(message.bot.data['redis'], message.chat.id)
+    await handle_finish(message, state, JOURNALED_REGISTRATION_TEXT)
+
+
+async def replay_registration(bot, record, maybe_delivered=False):
+    try:
+        if record['deferred_commit']:
+            participant_number = await commit_participant(
+                bot.data['1c_client'], record['document'],
+                record['instagram'], record['user_name'], record['phone_number']
+            )
+        else:
+            participant_number = await update_users_phone(
+                bot.data['1c_client'], record['document'], record['phone_number']
+            )
+    except AccountIsParticipat:
+        if maybe_delivered:
+            # 1С уже приняла эту регистрацию при прошлой попытке, ответ на которую не дошел до бота
+            logger.info(f'Регистрация {record["id"]} из журнала уже принята 1С')
+            return
+        # 1С отказала в регистрации, повторять запрос бессмысленно
+        with suppress(TelegramAPIError):
+            await bot.send_message(record['chat_id'], REPLAYED_ACCOUNT_IS_PARTICIPAT_TEXT)
+        return
+    final_text = get_final_text(participant_number)
+    with suppress(TelegramAPIError):
+        await bot.send_message(record['chat_id'], final_text, parse_mode=types.ParseMode.MARKDOWN)
+    if bot.data['sms_dispatcher']:
+        await bot.data['sms_dispatcher'].enqueue(record['phone_number'], final_text, record['chat_id'])
+
+
+@handle_mistakes()
+@handle_sms()
+async def cmd_phone_number_handle(message: types.Message, state: FSMContext):
+    if not re.match(r'''^([78]?9\d{9})$''', message.text):
+        raise IncorrectUserPhone
+    user_data = await state.get_data()
+    if message.bot.data['deferred_commit']:
+        try:
+            participant_number = await commit_participant(
+                message.bot.data['1c_client'], user_data['document'],
+                user_data['instagram'], user_data['user_name'], message.text
+            )
+        except AccountIsParticipat:
+            await ConversationSteps.waiting_for_insta.set()
+            raise
+        except (ServiceUnavailable, HTTPError, ConnectionError) as error:
+            if not message.bot.data['journal'] or not is_transient_error(error):
+                raise
+            await journal_registration(message, state, user_data, error)
+            return
+    else:
+        try:
+            participant_number = await update_users_phone(
+                message.bot.data['1c_client'], user_data['document'], message.text
+            )
+        except (ServiceUnavailable, HTTPError, ConnectionError) as error:
+            if not message.bot.data['journal'] or not is_transient_error(error):
+                raise
+            await journal_registration(message, state, user_data, error)
+            return
+    await state.update_data(phone_number=message.text)
+    message.bot.data['funnel_recorder'].record(message.chat.id, 'finish')
+    await add_participant(message.bot.data['redis'], message.chat.id)
+    final_text = get_final_text(participant_number)
     await handle_finish(message, state, final_text)
-    return user_data, final_text
+    return {**user_data, 'phone_number': message.text}, final_text
 
 
 @handle_mistakes()
 async def cmd_instagram_handle(message: types.Message, state: FSMContext):
     if not re.match(r'''^@?[a-zA-Z0-9-_.]{5,16}''', message.text):
         raise IncorrectUserInstagram
-    user_data = await state.get_data()
-    accountUsedToday = await update_users_instagram(
-        message.bot.data['1c_url'], user_data['document'], message.text
-    )
-    if accountUsedToday:
-        raise AccountIsParticipat
-    await state.update_data(instagram=message.text)
+    if message.bot.data['check_insta_account']:
+        is_valid_account = await check_insta_account(
+            message.bot.data['insta_cache'], message.text, message.bot.data['insta_bot'],
+            timeout=message.bot.data['insta_check_timeout']
+        )
+        # Если Instagram не ответил, не препятствуем регистрации
+        if is_valid_account is False:
+            raise InvalidInstagramAccount
+    if not message.bot.data['deferred_commit']:
+        user_data = await state.get_data()
+        accountUsedToday = await update_users_instagram(
+            message.bot.data['1c_client'], user_data['document'], message.text
+        )
+        if accountUsedToday:
+            raise AccountIsParticipat
     await show_answer(message, 'Введите свое Ф.И.О. (в формате "Иванов Иван Иванович"):')
-    await ConversationSteps.next()
+    await save_step(state, ConversationSteps.waiting_for_user_name, instagram=message.text)
+    message.bot.data['funnel_recorder'].record(message.chat.id, 'user_name')
 
 
 async def send_finish(call: types.CallbackQuery):
     state = Dispatcher.get_current().current_state()
+    call.bot.data['funnel_recorder'].record(call.message.chat.id, 'cancel')
     await handle_finish(
         call.message, state,
         'Участие в розыгрыше отменено. Благодарим за проявленный интерес.'
@@ -327,8 +452,7 @@ async def send_continue(call: types.CallbackQuery):
     state = Dispatcher.get_current().current_state()
     current_state = await state.get_state()
     if current_state == 'ConversationSteps:waiting_for_insta':
-        img = await read_file(Path(config.MEDIAFILES_DIRS, 'demo_insta.jpg'))
-        await show_answer(call.message, 'Введите название своего аккаунта Instagram:', img)
+        await show_answer(call.message, 'Введите название своего аккаунта Instagram:', DEMO_INSTA_IMAGE)
     elif current_state == 'ConversationSteps:waiting_for_user_name':
         await show_answer(call.message, 'Введите свое Ф.И.О. (в формате "Иванов Иван Иванович"):')
     elif current_state == 'ConversationSteps:waiting_for_phone_number':
@@ -368,46 +492,272 @@ def register_handlers_common(dp: Dispatcher):
     dp.register_callback_query_handler(send_continue, text="continue", state='*')
 
 
+def register_metrics_callbacks(bot):
+    metrics_registry.constant_labels['worker'] = bot.data['worker_index']
+
+    async def get_queue_depths():
+        queue_depths = {
+            ('monitoring',): monitoring_shipper.stats()['queue_depth'],
+            ('rollbar',): rollbar_reporter.stats()['queue_depth'],
+            ('delete_messages',): await bot.data['deletion_scheduler'].queue.size(),
+            ('funnel',): bot.data['funnel_recorder'].stats()['queue_depth'],
+            ('outbound_interactive',): bot.data['outbound_scheduler'].stats()['waiting_interactive'],
+            ('outbound_background',): bot.data['outbound_scheduler'].stats()['waiting_background'],
+        }
+        if bot.data['journal']:
+            queue_depths[('journal_writes',)] = bot.data['journal'].stats()['pending_writes']
+        if bot.data['sms_dispatcher']:
+            queue_depths[('sms_outbox',)] = await bot.data['sms_dispatcher'].outbox.size()
+            queue_depths[('sms_delivery',)] = await bot.data['sms_dispatcher'].delivery.size()
+        return queue_depths
+
+    async def get_monitoring_events():
+        stats = monitoring_shipper.stats()
+        return {(result,): stats[result] for result in monitoring_shipper.counters}
+
+    async def get_rollbar_reports():
+        stats = rollbar_reporter.stats()
+        return {(result,): stats[result] for result in rollbar_reporter.counters}
+
+    async def get_circuit_states():
+        return {
+            ('1c', operation): CIRCUIT_STATES[stats['state']]
+            for operation, stats in bot.data['1c_breakers'].stats().items()
+        }
+
+    async def get_circuit_calls():
+        return {
+            ('1c', operation, result): stats[result]
+            for operation, stats in bot.data['1c_breakers'].stats().items()
+            for result in ('calls', 'failures', 'rejected_open', 'rejected_busy', 'opened')
+        }
+
+    async def get_bulkhead_in_use():
+        return {
+            ('1c', operation): stats['in_use'] for operation, stats in bot.data['1c_breakers'].stats().items()
+        }
+
+    async def get_journal_records():
+        if not bot.data['journal']:
+            return {}
+        return {
+            ('appended',): bot.data['journal'].stats()['appended'],
+            **{(result,): count for result, count in bot.data['journal_replayer'].stats().items()},
+        }
+
+    async def get_throttled_updates():
+        if not bot.data['throttling']:
+            return {}
+        return {(result,): count for result, count in bot.data['throttling'].stats().items()}
+
+    async def get_outbound_requests():
+        stats = bot.data['outbound_scheduler'].stats()
+        return {(result,): stats[result] for result in ('sent', 'waited', 'retry_after')}
+
+    async def get_broadcast_messages():
+        return {(result,): count for result, count in bot.data['broadcast_worker'].stats().items()}
+
+    async def get_cache_requests():
+        cache_requests = {
+            (cache, result): bot.data[cache].counters[result]
+            for cache in ('insta_cache', 'check_number_cache') for result in ('hits', 'misses')
+        }
+        if bot.data['fsm_cache']:
+            cache_requests.update({
+                ('fsm', result): bot.data['fsm_cache'].counters[result] for result in ('hits', 'misses')
+            })
+        return cache_requests
+
+    metrics_registry.callback(
+        'cmstore_queue_depth', 'Количество задач в очередях фоновой обработки.', ('queue',), get_queue_depths
+    )
+    metrics_registry.callback(
+        'cmstore_monitoring_events_total', 'События мониторинга по результату отправки.', ('result',),
+        get_monitoring_events, type='counter'
+    )
+    metrics_registry.callback(
+        'cmstore_rollbar_reports_total', 'Ошибки для Rollbar по результату постановки в очередь.', ('result',),
+        get_rollbar_reports, type='counter'
+    )
+    metrics_registry.callback(
+        'cmstore_circuit_state', 'Состояние предохранителя: 0 - закрыт, 1 - пробный запрос, 2 - открыт.',
+        ('dependency', 'operation'), get_circuit_states
+    )
+    metrics_registry.callback(
+        'cmstore_circuit_calls_total', 'Вызовы через предохранитель по результату.',
+        ('dependency', 'operation', 'result'), get_circuit_calls, type='counter'
+    )
+    metrics_registry.callback(
+        'cmstore_bulkhead_in_use', 'Количество одновременных запросов операции.',
+        ('dependency', 'operation'), get_bulkhead_in_use
+    )
+    metrics_registry.callback(
+        'cmstore_journal_records_total', 'Регистрации, сохраненные в журнал и отправленные из него в 1С.',
+        ('result',), get_journal_records, type='counter'
+    )
+    metrics_registry.callback(
+        'cmstore_throttling_updates_total', 'Обновления, прошедшие и отклоненные ограничением частоты.',
+        ('result',), get_throttled_updates, type='counter'
+    )
+    metrics_registry.callback(
+        'cmstore_outbound_requests_total',
+        'Запросы к Bot API через планировщик: отправленные, ожидавшие токен и получившие RetryAfter.',
+        ('result',), get_outbound_requests, type='counter'
+    )
+    metrics_registry.callback(
+        'cmstore_broadcast_messages_total', 'Сообщения рассылок по результату отправки.',
+        ('result',), get_broadcast_messages, type='counter'
+    )
+    metrics_registry.callback(
+        'cmstore_cache_requests_total', 'Обращения к общим кэшам.', ('cache', 'result'),
+        get_cache_requests, type='counter'
+    )
+
+
+def start_journal(bot):
+    # каждый процесс пишет в свой каталог журнала и отправляет из него регистрации в 1С
+    worker_index, workers = bot.data['worker_index'], bot.data['webhook_workers']
+    bot.data['journal'] = RegistrationJournal(Path(bot.data['journal_dir'], f'worker-{worker_index}'))
+    bot.data['journal'].start()
+    # журналы процессов, которых больше нет после уменьшения WEBHOOK_WORKERS
+    orphan_journals = [
+        RegistrationJournal(path) for path in Path(bot.data['journal_dir']).glob('worker-*')
+        if path.name[len('worker-'):].isdigit()
+        and int(path.name[len('worker-'):]) >= workers
+        and int(path.name[len('worker-'):]) % workers == worker_index
+    ]
+    bot.data['journal_replayer'] = JournalReplayer(
+        [bot.data['journal'], *orphan_journals],
+        functools.partial(replay_registration, bot),
+        bot.data['redis'],
+        rate=bot.data['journal_replay_rate']
+    )
+    bot.data['background_tasks'].append(asyncio.create_task(bot.data['journal_replayer'].run()))
+
+
 async def on_shutdown(dispatcher: Dispatcher):
     logger.info('Shutdown.')
     bot = dispatcher.bot
-    if bot.data['use_webhook']:
+    if bot.data['use_webhook'] and bot.data['worker_index'] == 0:
         await bot.delete_webhook()
     if bot.data['insta_bot']:
         bot.data['insta_bot'].logout()
+    for task in bot.data['background_tasks']:
+        task.cancel()
+    await bot.data['funnel_recorder'].stop()
+    if bot.data['journal']:
+        await bot.data['journal'].close()
+    if bot.data['metrics_runner']:
+        await bot.data['metrics_runner'].cleanup()
+    await bot.data['1c_client'].close()
+    await monitoring_shipper.stop()
+    await rollbar_reporter.drain()
     # Close Redis connection.
     await dispatcher.storage.close()
     await dispatcher.storage.wait_closed()
+    await bot.data['redis'].close()
 
 
 async def on_startup(dispatcher: Dispatcher):
     logger.info('Startup.')
     bot = dispatcher.bot
-    if bot.data['use_webhook']:
+    if bot.data['use_webhook'] and bot.data['worker_index'] == 0:
         await bot.set_webhook(bot.data['webhook_url'])
+    bot.data['outbound_scheduler'] = OutboundScheduler(
+        bot.data['redis'],
+        global_limit=bot.data['outbound_global_limit'],
+        chat_limit=bot.data['outbound_chat_limit'],
+        group_limit=bot.data['outbound_group_limit']
+    )
+    bot.data['media_store'] = MediaStore(bot.data['redis'])
+    bot.data['insta_cache'] = SharedCache(bot.data['redis'], 'insta')
+    bot.data['check_number_cache'] = SharedCache(bot.data['redis'], 'check_number')
+    monitoring_shipper.start()
+    bot.data['1c_breakers'] = CircuitBreakers(
+        bot.data['redis'], prefix='circuit:1c',
+        failure_threshold=bot.data['1c_failure_threshold'],
+        reset_timeout=bot.data['1c_reset_timeout'],
+        max_concurrency=bot.data['1c_bulkhead'],
+        acquire_timeout=bot.data['1c_bulkhead_timeout'],
+        errors=(HTTPError, ConnectionError)
+    )
+    bot.data['1c_client'] = OneCClient(
+        bot.data['1c_url'],
+        connections=bot.data['1c_connections'],
+        timeout=bot.data['1c_timeout'],
+        breakers=bot.data['1c_breakers']
+    )
+    bot.data['max_number_length'] = CachedValue(
+        functools.partial(get_max_number_length, bot.data['1c_client']),
+        ttl=bot.data['max_number_length_ttl'],
+        errors=(UnableGetCharacters,)
+    )
+    bot.data['max_number_length'].refresh()
+    await config_cache.reload()
+    bot.data['deletion_scheduler'] = DeletionScheduler(
+        bot.data['redis'], delay=bot.data['delete_messages_delay']
+    )
+    bot.data['funnel_recorder'] = FunnelRecorder(bot.data['redis'])
+    bot.data['background_tasks'] = [
+        asyncio.create_task(config_cache.watch()),
+        asyncio.create_task(bot.data['deletion_scheduler'].run(bot)),
+        asyncio.create_task(bot.data['funnel_recorder'].run()),
+        asyncio.create_task(bot.data['1c_breakers'].run()),
+    ]
+    if bot.data['sms_api_id']:
+        bot.data['sms_dispatcher'] = SmsDispatcher(bot.data['redis'], bot.data['sms_api_id'])
+        bot.data['background_tasks'] += [
+            asyncio.create_task(bot.data['sms_dispatcher'].run_sender()),
+            asyncio.create_task(bot.data['sms_dispatcher'].run_poller()),
+        ]
+    bot.data['broadcast_worker'] = BroadcastWorker(
+        BroadcastStore(bot.data['redis']), bot, concurrency=bot.data['broadcast_concurrency']
+    )
+    bot.data['background_tasks'].append(asyncio.create_task(bot.data['broadcast_worker'].run()))
+    bot.data['journal'] = None
+    if bot.data['journal_dir']:
+        start_journal(bot)
+    bot.data['fsm_cache'] = None
+    if isinstance(dispatcher.storage, CachedStorage):
+        bot.data['fsm_cache'] = dispatcher.storage
+    register_metrics_callbacks(bot)
+    bot.data['metrics_runner'] = None
+    if bot.data['metrics_port']:
+        # у каждого процесса бота свой порт метрик
+        bot.data['metrics_runner'] = await start_metrics_server(
+            bot.data['metrics_host'], bot.data['metrics_port'] + bot.data['worker_index']
+        )
     # Установка команд бота
     await set_commands(bot)
 
 
-@notify_rollbar()
-def main():
-
-    logging.basicConfig(
-        level='INFO',
-        format='%(asctime)s - %(levelname)s - %(name)s - %(message)s',
-    )
-
-    logger.info('Starting bot')
+def run_bot(worker_index=0):
+    bot = CMStoreBot(token=env.str('TG_BOT_TOKEN'))
 
-    storage = RedisStorage2(
+    config.set_bot_variables(bot, env)
+    bot.data['worker_index'] = worker_index
+    bot.data['redis'] = aioredis.Redis(
         host=env.str('REDIS_HOST', 'localhost'),
-        port=env.str('REDIS_PORT', '6379'),
-        db='5'
+        port=env.int('REDIS_PORT', 6379),
+        db=5,
+        decode_responses=True
     )
 
-    bot = Bot(token=env.str('TG_BOT_TOKEN'))
-
-    config.set_bot_variables(bot, env)
+    if bot.data['fsm_storage'] == 'compact':
+        storage = CompactRedisStorage(bot.data['redis'], ttl=bot.data['fsm_ttl'])
+    else:
+        storage = RedisStorage2(
+            host=env.str('REDIS_HOST', 'localhost'),
+            port=env.str('REDIS_PORT', '6379'),
+            db='5'
+        )
+    if bot.data['fsm_cache_size']:
+        # при нескольких процессах кэш сверяет версию чата в Redis
+        storage = CachedStorage(
+            storage,
+            bot.data['redis'] if bot.data['webhook_workers'] > 1 else None,
+            max_size=bot.data['fsm_cache_size']
+        )
 
     if env.str('INSTA_LOGIN'):
         with suppress(SystemExit, multiprocessing.context.TimeoutError):
@@ -417,6 +767,18 @@ def main():
 
     dp = Dispatcher(bot, storage=storage)
 
+    # Слишком частые обновления чата отбрасываются до блокировки чата и запросов к 1С
+    bot.data['throttling'] = None
+    if bot.data['throttle_limits']:
+        bot.data['throttling'] = ThrottlingMiddleware(bot.data['redis'], bot.data['throttle_limits'])
+        dp.middleware.setup(bot.data['throttling'])
+
+    # Обновления одного чата не должны обрабатываться несколькими процессами одновременно
+    if bot.data['webhook_workers'] > 1:
+        dp.middleware.setup(ChatLockMiddleware(
+            bot.data['redis'], fsm_cache=storage if isinstance(storage, CachedStorage) else None
+        ))
+
     # Обработчики логики бота
     register_handlers_common(dp)
 
@@ -424,18 +786,67 @@ def main():
     dp.register_errors_handler(errors_handler)
 
     if bot.data['use_webhook']:
-        start_webhook(
+        web_app = web.Application()
+        if bot.data['throttle_ip_limit']:
+            web_app.middlewares.append(create_ip_throttling_middleware(
+                bot.data['redis'], bot.data['throttle_ip_limit'], paths=('/webhook',)
+            ))
+        executor = set_webhook(
             dispatcher=dp,
             webhook_path='/webhook',
             on_startup=on_startup,
             on_shutdown=on_shutdown,
-            skip_updates=True,
+            skip_updates=worker_index == 0,
+            web_app=web_app,
+        )
+        executor.run_app(
             host=bot.data['webapp_host'],
             port=bot.data['webapp_port'],
+            reuse_port=bot.data['webhook_workers'] > 1,
         )
     else:
         start_polling(dp, on_startup=on_startup, on_shutdown=on_shutdown)
 
 
+@notify_rollbar()
+def run_worker(worker_index):
+    run_bot(worker_index)
+
+
+def run_workers(workers):
+    processes = [
+        multiprocessing.Process(target=run_worker, args=(worker_index,), name=f'cmstore-bot-{worker_index}')
+        for worker_index in range(workers)
+    ]
+    for process in processes:
+        process.start()
+    # Если один из процессов завершился, останавливаем остальные, чтобы сервис перезапустился целиком
+    with suppress(KeyboardInterrupt):
+        multiprocessing.connection.wait([process.sentinel for process in processes])
+    for process in processes:
+        if process.is_alive():
+            process.terminate()
+    for process in processes:
+        process.join()
+
+
+@notify_rollbar()
+def main():
+
+    logging.basicConfig(
+        level='INFO',
+        format='%(asctime)s - %(levelname)s - %(name)s - %(message)s',
+    )
+
+    logger.info('Starting bot')
+
+    workers = env.int('WEBHOOK_WORKERS', 1)
+    if env.bool('USE_WEBHOOK', True) and workers > 1:
+        logger.info(f'Starting {workers} webhook workers')
+        run_workers(workers)
+    else:
+        run_bot()
+
+
 if __name__ == "__main__":
     main()
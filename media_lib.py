@@ -0,0 +1,64 @@
+import os
+import logging
+
+from aiogram import types
+from aiogram.utils.exceptions import BadRequest
+from contextlib import suppress
+
+logger = logging.getLogger('cmstore-bot')
+
+
+class MediaStore:
+    """Uploads every media file to Telegram once and then sends it by file_id.
+
+    The file_id is kept in Redis under a key built from the path, mtime and size
+    of the file, so when serv.py replaces the picture it is uploaded again.
+    """
+
+    def __init__(self, redis, prefix='media', ttl=30 * 24 * 60 * 60):
+        self.redis = redis
+        self.prefix = prefix
+        self.ttl = ttl
+        self.file_ids = {}
+
+    def get_key(self, path):
+        stat = os.stat(path)
+        return f'{self.prefix}:{os.path.abspath(path)}:{stat.st_mtime_ns}:{stat.st_size}'
+
+    async def get_file_id(self, key):
+        with suppress(KeyError):
+            cached_key, file_id = self.file_ids[key.rsplit(':', 2)[0]]
+            if cached_key == key:
+                return file_id
+        file_id = await self.redis.get(key)
+        if file_id:
+            self.file_ids[key.rsplit(':', 2)[0]] = (key, file_id)
+        return file_id
+
+    async def remember(self, key, file_id):
+        self.file_ids[key.rsplit(':', 2)[0]] = (key, file_id)
+        await self.redis.set(key, file_id, ex=self.ttl)
+
+    async def forget(self, key):
+        self.file_ids.pop(key.rsplit(':', 2)[0], None)
+        await self.redis.delete(key)
+
+    async def answer_photo(self, message, path, **kwargs):
+        try:
+            key = self.get_key(path)
+        except (FileNotFoundError, TypeError):
+            return None
+
+        file_id = await self.get_file_id(key)
+        if file_id:
+            try:
+                return await message.answer_photo(photo=file_id, **kwargs)
+            except BadRequest as error:
+                # file_id мог стать недействительным, в этом случае загружаем файл заново
+                logger.warning(f'Не удалось отправить {path} по file_id: {error}')
+                await self.forget(key)
+
+        media_msg = await message.answer_photo(photo=types.InputFile(path), **kwargs)
+        if media_msg.photo:
+            await self.remember(key, media_msg.photo[-1].file_id)
+        return media_msg
@@ -0,0 +1,207 @@
+import time
+import math
+
+from bisect import bisect_left
+from contextlib import asynccontextmanager
+from aiohttp import web
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+
+def format_value(value):
+    if value == math.inf:
+        return '+Inf'
+    return repr(float(value))
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    escaped = (
+        (name, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+        for name, value in labels
+    )
+    return '{' + ','.join(f'{name}="{value}"' for name, value in escaped) + '}'
+
+
+class Metric:
+    type = 'untyped'
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.values = {}
+
+    def get_key(self, labels):
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    async def collect(self):
+        """Samples of the metric: (name suffix, label values, extra labels, value)."""
+        for key, value in self.values.items():
+            yield '', key, (), value
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self.get_key(labels)
+        self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    type = 'gauge'
+
+    def set(self, value, **labels):
+        self.values[self.get_key(labels)] = value
+
+    def inc(self, amount=1, **labels):
+        key = self.get_key(labels)
+        self.values[key] = self.values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+
+    def observe(self, value, **labels):
+        key = self.get_key(labels)
+        if key not in self.values:
+            self.values[key] = [[0] * len(self.buckets), 0, 0]
+        bucket_counts, _, _ = observation = self.values[key]
+        bucket_counts[bisect_left(self.buckets, value)] += 1
+        observation[1] += value
+        observation[2] += 1
+
+    async def collect(self):
+        for key, (bucket_counts, total, count) in self.values.items():
+            cumulative = 0
+            for upper_bound, bucket_count in zip(self.buckets, bucket_counts):
+                cumulative += bucket_count
+                yield '_bucket', key, (('le', format_value(upper_bound)),), cumulative
+            yield '_sum', key, (), total
+            yield '_count', key, (), count
+
+
+class CallbackMetric(Metric):
+    """Metric whose values are returned by `callback` coroutine on every scrape.
+
+    The callback returns a dict of label values tuples to metric values.
+    """
+
+    def __init__(self, name, documentation, labelnames=(), callback=None, type='gauge'):
+        super().__init__(name, documentation, labelnames)
+        self.callback = callback
+        self.type = type
+
+    async def collect(self):
+        values = await self.callback()
+        for key, value in values.items():
+            yield '', tuple(str(label) for label in key), (), value
+
+
+class MetricsRegistry:
+    """Metrics of the bot process rendered in Prometheus text format."""
+
+    def __init__(self):
+        self.metrics = {}
+        self.constant_labels = {}
+
+    def register(self, metric):
+        # повторная регистрация, например при перезапуске on_startup, возвращает существующую метрику
+        return self.metrics.setdefault(metric.name, metric)
+
+    def counter(self, name, documentation, labelnames=()):
+        return self.register(Counter(name, documentation, labelnames))
+
+    def gauge(self, name, documentation, labelnames=()):
+        return self.register(Gauge(name, documentation, labelnames))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self.register(Histogram(name, documentation, labelnames, buckets))
+
+    def callback(self, name, documentation, labelnames, callback, type='gauge'):
+        metric = CallbackMetric(name, documentation, labelnames, callback, type)
+        self.metrics[name] = metric
+        return metric
+
+    async def render(self):
+        constant_labels = tuple(self.constant_labels.items())
+        lines = []
+        for metric in self.metrics.values():
+            lines.append(f'# HELP {metric.name} {metric.documentation}')
+            lines.append(f'# TYPE {metric.name} {metric.type}')
+            async for suffix, key, extra_labels, value in metric.collect():
+                labels = constant_labels + tuple(zip(metric.labelnames, key)) + extra_labels
+                lines.append(f'{metric.name}{suffix}{format_labels(labels)} {format_value(value)}')
+        return '\n'.join(lines) + '\n'
+
+    async def handle(self, request):
+        return web.Response(text=await self.render(), content_type='text/plain', charset='utf-8')
+
+
+registry = MetricsRegistry()
+
+handler_duration = registry.histogram(
+    'cmstore_handler_duration_seconds', 'Время обработки сообщения обработчиком.', ('handler',)
+)
+handler_in_flight = registry.gauge(
+    'cmstore_handler_in_flight', 'Количество выполняющихся обработчиков.', ('handler',)
+)
+handler_errors = registry.counter(
+    'cmstore_handler_errors_total', 'Исключения обработчиков по классам.', ('handler', 'exception')
+)
+dependency_duration = registry.histogram(
+    'cmstore_dependency_duration_seconds', 'Время запросов к внешним сервисам.', ('dependency', 'operation')
+)
+dependency_in_flight = registry.gauge(
+    'cmstore_dependency_in_flight', 'Количество выполняющихся запросов к внешним сервисам.', ('dependency',)
+)
+dependency_errors = registry.counter(
+    'cmstore_dependency_errors_total', 'Ошибки запросов к внешним сервисам по классам.',
+    ('dependency', 'operation', 'exception')
+)
+
+
+@asynccontextmanager
+async def track_handler(handler):
+    handler_in_flight.inc(handler=handler)
+    started_at = time.perf_counter()
+    try:
+        yield
+    except Exception as error:
+        handler_errors.inc(handler=handler, exception=type(error).__name__)
+        raise
+    finally:
+        handler_duration.observe(time.perf_counter() - started_at, handler=handler)
+        handler_in_flight.dec(handler=handler)
+
+
+@asynccontextmanager
+async def track_dependency(dependency, operation):
+    dependency_in_flight.inc(dependency=dependency)
+    started_at = time.perf_counter()
+    try:
+        yield
+    except Exception as error:
+        dependency_errors.inc(dependency=dependency, operation=operation, exception=type(error).__name__)
+        raise
+    finally:
+        dependency_duration.observe(time.perf_counter() - started_at, dependency=dependency, operation=operation)
+        dependency_in_flight.dec(dependency=dependency)
+
+
+async def start_metrics_server(host, port):
+    app = web.Application()
+    app.router.add_get('/metrics', registry.handle)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    return runner
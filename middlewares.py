@@ -0,0 +1,192 @@
+import time
+import uuid
+import asyncio
+import ipaddress
+
+from aiogram import types, Dispatcher
+from aiogram.dispatcher.handler import CancelHandler
+from aiogram.dispatcher.middlewares import BaseMiddleware
+from aiogram.utils.exceptions import TelegramAPIError
+from aiohttp import web
+from contextlib import suppress
+
+# Адреса, с которых Telegram отправляет запросы на webhook
+TELEGRAM_NETWORKS = tuple(ipaddress.ip_network(network) for network in ('149.154.160.0/20', '91.108.4.0/22'))
+
+RELEASE_LOCK_SCRIPT = '''
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+'''
+
+# Корзина токенов: пополняется на ARGV[1] токенов в секунду до ARGV[2], запрос забирает один токен.
+# Возвращает 1, если запрос разрешен, -1 при первом отказе подряд и 0 при следующих отказах.
+# ARGV: скорость пополнения, емкость, текущее время.
+TOKEN_BUCKET_SCRIPT = '''
+local rate, capacity, now = tonumber(ARGV[1]), tonumber(ARGV[2]), tonumber(ARGV[3])
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'updated_at', 'denied')
+local tokens = tonumber(bucket[1]) or capacity
+local updated_at = tonumber(bucket[2]) or now
+tokens = math.min(capacity, tokens + math.max(0, now - updated_at) * rate)
+local result = 1
+if tokens >= 1 then
+    tokens = tokens - 1
+    redis.call('HDEL', KEYS[1], 'denied')
+elseif bucket[3] then
+    result = 0
+else
+    redis.call('HSET', KEYS[1], 'denied', 1)
+    result = -1
+end
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'updated_at', ARGV[3])
+redis.call('EXPIRE', KEYS[1], math.ceil(capacity / rate) + 1)
+return result
+'''
+
+THROTTLED_TEXT = 'Слишком много сообщений. Подождите немного и повторите.'
+
+
+def parse_limit(limit):
+    """Parse `<tokens>/<seconds>` into (refill rate per second, capacity)."""
+    tokens, seconds = limit.split('/')
+    return float(tokens) / float(seconds), float(tokens)
+
+
+async def take_token(redis, key, limit):
+    rate, capacity = limit
+    return await redis.eval(TOKEN_BUCKET_SCRIPT, 1, key, rate, capacity, time.time())
+
+
+def get_update_chat_id(update: types.Update):
+    if update.message:
+        return update.message.chat.id
+    if update.edited_message:
+        return update.edited_message.chat.id
+    if update.callback_query:
+        if update.callback_query.message:
+            return update.callback_query.message.chat.id
+        return update.callback_query.from_user.id
+    return None
+
+
+class ChatLockMiddleware(BaseMiddleware):
+    """Does not let several bot processes handle updates of one chat at the same time.
+
+    The lock is a Redis key with a TTL, so a crashed process holds the chat
+    no longer than `lock_ttl` seconds. With `fsm_cache` the version of the
+    chat in the cache is read in the same request as the lock.
+    """
+
+    def __init__(self, redis, lock_ttl=60, retry_interval=0.02, fsm_cache=None):
+        self.redis = redis
+        self.lock_ttl = lock_ttl
+        self.retry_interval = retry_interval
+        self.fsm_cache = fsm_cache
+        super().__init__()
+
+    async def acquire(self, key, token, chat_id):
+        async with self.redis.pipeline(transaction=True) as pipe:
+            pipe.set(key, token, nx=True, px=int(self.lock_ttl * 1000))
+            if self.fsm_cache:
+                pipe.get(self.fsm_cache.get_version_key(chat_id))
+            results = await pipe.execute()
+        return results[0], results[1] if self.fsm_cache else None
+
+    async def on_pre_process_update(self, update: types.Update, data: dict):
+        chat_id = get_update_chat_id(update)
+        if chat_id is None:
+            return
+        key = f'chat_lock:{chat_id}'
+        token = uuid.uuid4().hex
+        locked, version = await self.acquire(key, token, chat_id)
+        while not locked:
+            await asyncio.sleep(self.retry_interval)
+            locked, version = await self.acquire(key, token, chat_id)
+        version_token = self.fsm_cache.set_locked_version(chat_id, version) if self.fsm_cache else None
+        data['chat_lock'] = (key, token, version_token)
+
+    async def on_post_process_update(self, update: types.Update, results, data: dict):
+        if 'chat_lock' in data:
+            key, token, version_token = data.pop('chat_lock')
+            if self.fsm_cache:
+                self.fsm_cache.reset_locked_version(version_token)
+            await self.redis.eval(RELEASE_LOCK_SCRIPT, 1, key, token)
+
+
+class ThrottlingMiddleware(BaseMiddleware):
+    """Limits how often one chat may send updates with a token bucket in Redis.
+
+    `limits` maps FSM state names, full or without the group, to
+    `<tokens>/<seconds>` limits, `default` is used for other states. The first
+    update over the limit gets a short answer, the following ones are
+    dropped silently until the bucket refills.
+    """
+
+    def __init__(self, redis, limits, prefix='throttle'):
+        self.redis = redis
+        self.limits = {name: parse_limit(limit) for name, limit in limits.items()}
+        self.prefix = prefix
+        self.counters = {'allowed': 0, 'throttled': 0}
+        super().__init__()
+
+    def stats(self):
+        return dict(self.counters)
+
+    def get_limit_name(self, state):
+        if state in self.limits:
+            return state
+        if state and state.split(':')[-1] in self.limits:
+            return state.split(':')[-1]
+        return 'default'
+
+    async def on_pre_process_update(self, update: types.Update, data: dict):
+        chat_id = get_update_chat_id(update)
+        if chat_id is None:
+            return
+        state = await Dispatcher.get_current().current_state(chat=chat_id, user=chat_id).get_state()
+        limit_name = self.get_limit_name(state)
+        if limit_name not in self.limits:
+            return
+        result = await take_token(self.redis, f'{self.prefix}:{chat_id}:{limit_name}', self.limits[limit_name])
+        if result == 1:
+            self.counters['allowed'] += 1
+            return
+        self.counters['throttled'] += 1
+        if result == -1:
+            with suppress(TelegramAPIError):
+                if update.message:
+                    await update.message.answer(THROTTLED_TEXT)
+                elif update.callback_query:
+                    await update.callback_query.answer(THROTTLED_TEXT)
+        raise CancelHandler()
+
+
+def is_telegram_address(address):
+    with suppress(ValueError):
+        return any(ipaddress.ip_address(address) in network for network in TELEGRAM_NETWORKS)
+    return False
+
+
+def create_ip_throttling_middleware(redis, limit, paths, prefix='throttle:ip'):
+    """aiohttp middleware answering 429 to addresses that send requests to `paths` over the limit.
+
+    The address is taken from X-Real-IP set by nginx. Telegram sends all
+    updates from a few addresses, limiting them would throttle every user
+    and make Telegram retry with backoff, so Telegram networks are never
+    limited: the limit only stops other clients flooding the webhook.
+    """
+    limit = parse_limit(limit)
+
+    @web.middleware
+    async def ip_throttling_middleware(request, handler):
+        if request.path not in paths:
+            return await handler(request)
+        address = request.headers.get('X-Real-IP', request.remote)
+        if is_telegram_address(address):
+            return await handler(request)
+        if await take_token(redis, f'{prefix}:{address}', limit) != 1:
+            raise web.HTTPTooManyRequests()
+        return await handler(request)
+
+    return ip_throttling_middleware
@@ -1,11 +1,15 @@
 from __future__ import annotations
 
 import asks
+import random
+import asyncio
 import functools
 
+from collections import deque
 from environs import Env
 from contextlib import suppress
 from datetime import datetime
+from metrics_lib import track_dependency, track_handler
 
 env = Env()
 env.read_env()
@@ -24,26 +28,114 @@ def prepare_params(message, status):
     }
 
 
-async def request_data(status, *message_seq):
-    with suppress(Exception):  # Гарантирует выполнение остального кода, вне зависимости от мониторинга
-        message = message_seq[0]
-        params = prepare_params(message, status)
-        response = await asks.post(
-            monitoring_url, json=params
-        )
-        response.raise_for_status()
+class MonitoringShipper:
+    """Sends monitoring events from a background task.
+
+    Events are posted one by one in the format MONITORING_SERVER expects, a
+    `batch_size` above 1 posts a JSON list of events instead and needs a
+    server that accepts lists. Handlers only put events into a bounded
+    in-memory queue. When the queue is filled above `sample_threshold` only
+    `sample_rate` part of new events is kept, when it is full new events are
+    dropped.
+    """
+
+    def __init__(self, url, max_queue_size=10000, batch_size=1, flush_interval=1,
+                 sample_threshold=0.5, sample_rate=0.1):
+        self.url = url
+        self.max_queue_size = max_queue_size
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.sample_threshold = sample_threshold
+        self.sample_rate = sample_rate
+        self.events = deque()
+        self.counters = {'enqueued': 0, 'sampled_out': 0, 'dropped': 0, 'sent': 0, 'failed': 0}
+        self.session = None
+        self.wakeup = None
+        self.worker = None
+        self.closing = False
+
+    def stats(self):
+        return {**self.counters, 'queue_depth': len(self.events)}
+
+    def put(self, status, *message_seq):
+        with suppress(Exception):  # Гарантирует выполнение остального кода, вне зависимости от мониторинга
+            params = prepare_params(message_seq[0], status)
+            if len(self.events) >= self.max_queue_size:
+                self.counters['dropped'] += 1
+                return
+            if len(self.events) >= self.max_queue_size * self.sample_threshold \
+                    and random.random() >= self.sample_rate:
+                self.counters['sampled_out'] += 1
+                return
+            self.events.append(params)
+            self.counters['enqueued'] += 1
+            if len(self.events) >= self.batch_size and self.wakeup:
+                self.wakeup.set()
+
+    async def send(self, batch):
+        with suppress(Exception):
+            # при размере пакета 1 событие отправляется в прежнем формате, без списка
+            async with track_dependency('monitoring', 'log'):
+                response = await self.session.post(
+                    self.url, json=batch if self.batch_size > 1 else batch[0]
+                )
+                response.raise_for_status()
+            self.counters['sent'] += len(batch)
+            return
+        self.counters['failed'] += len(batch)
+
+    async def flush(self):
+        while self.events:
+            batch = [self.events.popleft() for _ in range(min(self.batch_size, len(self.events)))]
+            await self.send(batch)
+
+    async def run(self):
+        while not self.closing:
+            with suppress(asyncio.TimeoutError):
+                await asyncio.wait_for(self.wakeup.wait(), self.flush_interval)
+            self.wakeup.clear()
+            await self.flush()
+        await self.flush()
+
+    def start(self):
+        self.closing = False
+        self.wakeup = asyncio.Event()
+        self.session = asks.Session(headers={'Connection': 'keep-alive'}, connections=2)
+        self.worker = asyncio.create_task(self.run())
+
+    async def stop(self, timeout=5):
+        if not self.worker:
+            return
+        self.closing = True
+        self.wakeup.set()
+        try:
+            await asyncio.wait_for(self.worker, timeout)
+        except asyncio.TimeoutError:
+            self.counters['dropped'] += len(self.events)
+            self.events.clear()
+        await self.session.close()
+        self.worker = None
+
+
+monitoring_shipper = MonitoringShipper(
+    monitoring_url,
+    max_queue_size=env.int('MONITORING_QUEUE_SIZE', 10000),
+    batch_size=env.int('MONITORING_BATCH_SIZE', 1),
+    flush_interval=env.float('MONITORING_FLUSH_INTERVAL', 1),
+)
 
 
 def handle_monitoring_log():
     def decorator(func):
         @functools.wraps(func)
         async def inner(*args, **kwargs):
-            await request_data('send confirmation to client', *args)
-            message_seq = await func(*args, **kwargs)
+            monitoring_shipper.put('send confirmation to client', *args)
+            async with track_handler(func.__name__):
+                message_seq = await func(*args, **kwargs)
             if not isinstance(message_seq, list):
-                await request_data('send result to client', *[message_seq])
+                monitoring_shipper.put('send result to client', *[message_seq])
             else:
-                await request_data('send result to client', *message_seq)
+                monitoring_shipper.put('send result to client', *message_seq)
             return message_seq
         return inner
     return decorator
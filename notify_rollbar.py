@@ -1,12 +1,104 @@
+import sys
+import time
+import asyncio
+import logging
+import threading
 import functools
 import rollbar
 
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import contextmanager, asynccontextmanager
 from environs import Env
 
 env = Env()
 env.read_env()
 
+logger = logging.getLogger('cmstore-bot')
+
+
+class RollbarReporter:
+    """Reports exceptions to Rollbar from a worker thread.
+
+    The caller only captures exc_info and puts it into the executor queue,
+    payload serialization and sending are done off the event loop. The same
+    exception raised from the same line is reported once per `dedup_window`
+    seconds.
+    """
+
+    def __init__(self, dedup_window=60, max_pending=1000):
+        self.dedup_window = dedup_window
+        self.max_pending = max_pending
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='rollbar')
+        self.pending = set()
+        self.reported_at = {}
+        self.lock = threading.Lock()
+        self.counters = {'enqueued': 0, 'deduplicated': 0, 'dropped': 0}
+
+    def stats(self):
+        return {**self.counters, 'queue_depth': len(self.pending)}
+
+    @staticmethod
+    def get_fingerprint(exc_info):
+        exc_type, exc_value, tb = exc_info
+        while tb and tb.tb_next:
+            tb = tb.tb_next
+        location = (tb.tb_frame.f_code.co_filename, tb.tb_lineno) if tb else None
+        return exc_type, str(exc_value)[:200], location
+
+    def is_duplicate(self, exc_info):
+        now = time.monotonic()
+        fingerprint = self.get_fingerprint(exc_info)
+        if self.reported_at.get(fingerprint, 0) > now:
+            return True
+        if len(self.reported_at) > self.max_pending:
+            self.reported_at = {
+                key: expires_at for key, expires_at in self.reported_at.items() if expires_at > now
+            }
+        self.reported_at[fingerprint] = now + self.dedup_window
+        return False
+
+    def report_exc_info(self, exc_info=None, level='error', extra_data=None):
+        exc_info = exc_info or sys.exc_info()
+        if exc_info[0] is None:
+            return
+        with self.lock:
+            if self.is_duplicate(exc_info):
+                self.counters['deduplicated'] += 1
+                return
+            if len(self.pending) >= self.max_pending:
+                self.counters['dropped'] += 1
+                return
+            self.counters['enqueued'] += 1
+            future = self.executor.submit(
+                rollbar.report_exc_info, exc_info, level=level, extra_data=extra_data
+            )
+            self.pending.add(future)
+        future.add_done_callback(self.forget)
+
+    def forget(self, future):
+        with self.lock:
+            self.pending.discard(future)
+
+    async def drain(self, timeout=10):
+        with self.lock:
+            pending = [asyncio.wrap_future(future) for future in self.pending]
+        if pending:
+            await asyncio.wait(pending, timeout=timeout)
+        if not rollbar._initialized:
+            return
+        loop = asyncio.get_running_loop()
+        try:
+            await asyncio.wait_for(loop.run_in_executor(self.executor, rollbar.wait), timeout)
+        except asyncio.TimeoutError:
+            logger.warning('Не все ошибки успели отправиться в Rollbar')
+
+
+rollbar_reporter = RollbarReporter(dedup_window=env.int('ROLLBAR_DEDUP_WINDOW', 60))
+
+
+def report_exc_info(exc_info=None, level='error', extra_data=None):
+    rollbar_reporter.report_exc_info(exc_info, level=level, extra_data=extra_data)
+
 
 def notify_rollbar():
 
@@ -40,11 +132,8 @@ def anotify_rollbar():
             try:
                 return await func(*args, **kwargs)
             except: # noqa
-                print("send to rollbar")
-                rollbar.report_exc_info()
+                report_exc_info()
                 raise
-            finally:
-                rollbar.wait()
 
         return func_wrapped
 
@@ -77,12 +166,9 @@ async def anotify_rollbar_from_context(level='error', extra_data=None):
     try:
         yield
     except: # noqa
-        rollbar.report_exc_info(level=level, extra_data=extra_data)
+        # Отправка выполняется в отдельном потоке, дождаться её можно через rollbar_reporter.drain()
+        report_exc_info(level=level, extra_data=extra_data)
         raise
-    finally:
-        # FIXME should replace with async version
-        # Avoid messages losing. Details are here https://docs.rollbar.com/docs/python#aws-lambda
-        rollbar.wait()
 
 
 def init_rollbar():
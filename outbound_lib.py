@@ -0,0 +1,148 @@
+import time
+import asyncio
+import logging
+
+from contextvars import ContextVar
+from aiogram.utils.exceptions import RetryAfter
+
+from middlewares import parse_limit
+
+logger = logging.getLogger('cmstore-bot')
+
+PRIORITY_INTERACTIVE = 'interactive'
+PRIORITY_BACKGROUND = 'background'
+
+# Методы Bot API, на которые действуют ограничения Telegram на отправку сообщений
+SCHEDULED_METHODS = {
+    'sendMessage', 'sendPhoto', 'sendMediaGroup', 'sendDocument', 'sendVideo', 'sendAnimation',
+    'copyMessage', 'forwardMessage', 'editMessageText', 'editMessageCaption', 'deleteMessage',
+}
+BACKGROUND_METHODS = {'deleteMessage'}
+# Методы, не отправляющие сообщений, не расходуют ограничение отправки в чат
+CHAT_EXEMPT_METHODS = {'deleteMessage'}
+
+# Приоритет запросов текущей задачи, рассылки устанавливают фоновый приоритет
+outbound_priority = ContextVar('outbound_priority', default=PRIORITY_INTERACTIVE)
+
+# Забирает по токену из общей корзины и корзины чата, если ни одна из них не приостановлена.
+# Фоновые запросы оставляют в общей корзине ARGV[6] токенов для ответов пользователям.
+# Если ARGV[7] не '1', корзина чата не используется.
+# Возвращает '0', если запрос можно отправлять, иначе сколько секунд подождать.
+# KEYS: общая корзина, корзина чата, паузы общей корзины и чата.
+# ARGV: время, скорость и емкость общей корзины, скорость и емкость корзины чата, резерв, учитывать ли чат.
+TAKE_TOKEN_SCRIPT = '''
+local now = tonumber(ARGV[1])
+local paused_until = math.max(tonumber(redis.call('GET', KEYS[3]) or 0), tonumber(redis.call('GET', KEYS[4]) or 0))
+if paused_until > now then
+    return tostring(paused_until - now)
+end
+
+local function refill(key, rate, capacity)
+    local bucket = redis.call('HMGET', key, 'tokens', 'updated_at')
+    local tokens = tonumber(bucket[1]) or capacity
+    local updated_at = tonumber(bucket[2]) or now
+    return math.min(capacity, tokens + math.max(0, now - updated_at) * rate)
+end
+
+local global_rate, global_capacity = tonumber(ARGV[2]), tonumber(ARGV[3])
+local chat_rate, chat_capacity = tonumber(ARGV[4]), tonumber(ARGV[5])
+local use_chat = ARGV[7] == '1'
+local global_tokens = refill(KEYS[1], global_rate, global_capacity)
+local chat_tokens = use_chat and refill(KEYS[2], chat_rate, chat_capacity) or 1
+local needed = 1 + tonumber(ARGV[6])
+local wait = 0
+if global_tokens < needed then
+    wait = (needed - global_tokens) / global_rate
+end
+if chat_tokens < 1 then
+    wait = math.max(wait, (1 - chat_tokens) / chat_rate)
+end
+if wait > 0 then
+    return tostring(wait)
+end
+
+redis.call('HSET', KEYS[1], 'tokens', tostring(global_tokens - 1), 'updated_at', ARGV[1])
+redis.call('EXPIRE', KEYS[1], math.ceil(global_capacity / global_rate) + 1)
+if use_chat then
+    redis.call('HSET', KEYS[2], 'tokens', tostring(chat_tokens - 1), 'updated_at', ARGV[1])
+    redis.call('EXPIRE', KEYS[2], math.ceil(chat_capacity / chat_rate) + 1)
+end
+return '0'
+'''
+
+
+class OutboundScheduler:
+    """Spaces Bot API requests to stay within Telegram limits shared by all bot processes.
+
+    Every request takes a token from the global bucket and from the bucket of
+    its chat, group chats have their own slower limit. Deletions and requests
+    without a chat (inline message edits) take only a global token. Background requests
+    (deletions, broadcasts) leave `background_reserve` global tokens to
+    replies, so users are answered first. RetryAfter pauses only the chat of
+    the request, or all requests when it has no chat, and the request is
+    sent again after the pause if it is not longer than `max_retry_after`,
+    at most `max_retries` times.
+    """
+
+    def __init__(self, redis, global_limit='30/1', chat_limit='3/3', group_limit='20/60',
+                 background_reserve=5, max_retry_after=60, max_retries=3, prefix='outbound'):
+        self.redis = redis
+        self.global_limit = parse_limit(global_limit)
+        self.chat_limit = parse_limit(chat_limit)
+        self.group_limit = parse_limit(group_limit)
+        self.background_reserve = background_reserve
+        self.max_retry_after = max_retry_after
+        self.max_retries = max_retries
+        self.prefix = prefix
+        self.counters = {'sent': 0, 'waited': 0, 'retry_after': 0}
+        self.waiting = {PRIORITY_INTERACTIVE: 0, PRIORITY_BACKGROUND: 0}
+
+    def stats(self):
+        return {**self.counters, **{f'waiting_{priority}': count for priority, count in self.waiting.items()}}
+
+    def get_scope(self, chat_id):
+        return f'chat:{chat_id}' if chat_id is not None else 'global'
+
+    async def wait_for_token(self, chat_id, priority, use_chat_bucket=True):
+        chat_rate, chat_capacity = self.group_limit if str(chat_id).startswith('-') else self.chat_limit
+        global_rate, global_capacity = self.global_limit
+        reserve = self.background_reserve if priority == PRIORITY_BACKGROUND else 0
+        self.waiting[priority] += 1
+        try:
+            while True:
+                wait = float(await self.redis.eval(
+                    TAKE_TOKEN_SCRIPT, 4,
+                    f'{self.prefix}:bucket:global', f'{self.prefix}:bucket:chat:{chat_id}',
+                    f'{self.prefix}:pause:global', f'{self.prefix}:pause:{self.get_scope(chat_id)}',
+                    time.time(), global_rate, global_capacity, chat_rate, chat_capacity, reserve,
+                    1 if use_chat_bucket and chat_id is not None else 0
+                ))
+                if not wait:
+                    return
+                self.counters['waited'] += 1
+                await asyncio.sleep(wait)
+        finally:
+            self.waiting[priority] -= 1
+
+    async def pause(self, chat_id, timeout):
+        paused_until = time.time() + timeout
+        await self.redis.set(f'{self.prefix}:pause:{self.get_scope(chat_id)}', paused_until, px=int(timeout * 1000))
+
+    async def send(self, request, method, data):
+        """Send the request when the limits allow, `request` is a coroutine function."""
+        chat_id = (data or {}).get('chat_id')
+        priority = PRIORITY_BACKGROUND if method in BACKGROUND_METHODS else outbound_priority.get()
+        for attempt in range(self.max_retries + 1):
+            await self.wait_for_token(chat_id, priority, method not in CHAT_EXEMPT_METHODS)
+            try:
+                result = await request()
+            except RetryAfter as error:
+                self.counters['retry_after'] += 1
+                logger.warning(f'Превышены ограничения Telegram, отправка в {self.get_scope(chat_id)} '
+                               f'приостановлена на {error.timeout} с')
+                await self.pause(chat_id, error.timeout)
+                if error.timeout > self.max_retry_after or attempt == self.max_retries:
+                    raise
+                continue
+            self.counters['sent'] += 1
+            return result
@@ -0,0 +1,144 @@
+import time
+import asyncio
+import logging
+
+from collections import defaultdict
+from contextlib import suppress
+from aiogram.utils.exceptions import (
+    MessageCantBeDeleted, MessageToDeleteNotFound, RetryAfter, TelegramAPIError
+)
+
+from notify_rollbar import report_exc_info
+
+logger = logging.getLogger('cmstore-bot')
+
+# Выдает элементы, срок которых наступил, и сдвигает их срок на время аренды,
+# чтобы их не забрал другой процесс. Если обработчик упадет, элементы вернутся в очередь.
+CLAIM_DUE_SCRIPT = '''
+local items = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1], 'LIMIT', 0, ARGV[2])
+for _, item in ipairs(items) do
+    redis.call('ZADD', KEYS[1], ARGV[3], item)
+end
+return items
+'''
+
+# Переносит накопленные сообщения чата в очередь удаления с единым сроком.
+SCHEDULE_CHAT_SCRIPT = '''
+for i = 3, #ARGV do
+    redis.call('RPUSH', KEYS[1], ARGV[i])
+end
+local message_ids = redis.call('LRANGE', KEYS[1], 0, -1)
+redis.call('DEL', KEYS[1])
+for _, message_id in ipairs(message_ids) do
+    redis.call('ZADD', KEYS[2], ARGV[2], ARGV[1] .. ':' .. message_id)
+end
+return #message_ids
+'''
+
+
+class DelayedQueue:
+    """Redis sorted set of members scored by the time they are due.
+
+    Members are claimed atomically, so the queue can be shared by several
+    bot processes. A claimed member is hidden for `lease` seconds and has to
+    be acknowledged or rescheduled, otherwise it becomes due again.
+    """
+
+    def __init__(self, redis, key, lease=60):
+        self.redis = redis
+        self.key = key
+        self.lease = lease
+
+    async def schedule(self, members, due_at):
+        if members:
+            await self.redis.zadd(self.key, {member: due_at for member in members})
+
+    async def claim(self, batch_size=100):
+        now = time.time()
+        return await self.redis.eval(
+            CLAIM_DUE_SCRIPT, 1, self.key, now, batch_size, now + self.lease
+        )
+
+    async def ack(self, members):
+        if members:
+            await self.redis.zrem(self.key, *members)
+
+    async def size(self):
+        return await self.redis.zcard(self.key)
+
+
+class DeletionScheduler:
+    """Deletes bot conversation messages some time after the conversation ends.
+
+    Message ids of an active conversation are kept in a Redis list with a
+    sliding TTL, so abandoned conversations expire. When the conversation ends
+    they are moved to a DelayedQueue which is drained by `run`.
+    """
+
+    def __init__(self, redis, delay=30, pending_ttl=24 * 60 * 60, batch_size=100,
+                 concurrency=10, chat_interval=0.1, poll_interval=1):
+        self.redis = redis
+        self.delay = delay
+        self.pending_ttl = pending_ttl
+        self.batch_size = batch_size
+        self.concurrency = concurrency
+        self.chat_interval = chat_interval
+        self.poll_interval = poll_interval
+        self.queue = DelayedQueue(redis, 'delete_messages:due')
+
+    @staticmethod
+    def get_pending_key(chat_id):
+        return f'delete_messages:pending:{chat_id}'
+
+    async def add(self, chat_id, message_ids):
+        key = self.get_pending_key(chat_id)
+        async with self.redis.pipeline(transaction=False) as pipe:
+            pipe.rpush(key, *message_ids)
+            pipe.expire(key, self.pending_ttl)
+            await pipe.execute()
+
+    async def schedule_chat(self, chat_id, message_ids=()):
+        await self.redis.eval(
+            SCHEDULE_CHAT_SCRIPT, 2,
+            self.get_pending_key(chat_id), self.queue.key,
+            chat_id, time.time() + self.delay, *message_ids
+        )
+
+    async def delete_chat_messages(self, bot, chat_id, members, semaphore):
+        async with semaphore:
+            for number, member in enumerate(members):
+                message_id = int(member.rsplit(':', 1)[-1])
+                try:
+                    with suppress(MessageCantBeDeleted, MessageToDeleteNotFound):
+                        await bot.delete_message(chat_id, message_id)
+                except RetryAfter as error:
+                    await self.queue.schedule(members[number:], time.time() + error.timeout)
+                    return members[:number]
+                except TelegramAPIError:
+                    report_exc_info()
+                await asyncio.sleep(self.chat_interval)
+        return members
+
+    async def run(self, bot):
+        semaphore = asyncio.Semaphore(self.concurrency)
+        while True:
+            try:
+                members = await self.queue.claim(self.batch_size)
+                if not members:
+                    await asyncio.sleep(self.poll_interval)
+                    continue
+                members_by_chat = defaultdict(list)
+                for member in members:
+                    chat_id, _ = member.rsplit(':', 1)
+                    members_by_chat[int(chat_id)].append(member)
+                processed = await asyncio.gather(*[
+                    self.delete_chat_messages(bot, chat_id, chat_members, semaphore)
+                    for chat_id, chat_members in members_by_chat.items()
+                ])
+                await self.queue.ack([member for chat_members in processed for member in chat_members])
+            except asyncio.CancelledError:
+                raise
+            except Exception as error:
+                logger.error(f'Ошибка удаления сообщений: {error}')
+                report_exc_info()
+                await asyncio.sleep(self.poll_interval)
@@ -1,12 +1,18 @@
+import hmac
 import asyncio
+import aioredis
+import functools
 import config
+import datetime
 
 from environs import Env
 from contextlib import suppress
 from quart import Quart, request, render_template, jsonify
 
 from cmstore_lib import update_config, decode_message
-from notify_rollbar import anotify_rollbar
+from notify_rollbar import anotify_rollbar, rollbar_reporter
+from funnel_lib import FunnelRecorder
+from broadcast_lib import BroadcastStore
 
 env = Env()
 env.read_env()
@@ -14,6 +20,35 @@ env.read_env()
 app = Quart(__name__, static_folder=config.MEDIAFILES_DIRS)
 app.config.from_object(config)
 
+redis = aioredis.Redis(
+    host=env.str('REDIS_HOST', 'localhost'),
+    port=env.int('REDIS_PORT', 6379),
+    db=5,
+    decode_responses=True
+)
+funnel_recorder = FunnelRecorder(redis)
+broadcast_store = BroadcastStore(redis)
+broadcast_token = env.str('BROADCAST_TOKEN', '')
+
+
+def require_broadcast_token():
+    def decorator(func):
+        @functools.wraps(func)
+        async def inner(*args, **kwargs):
+            # без токена рассылки отключены: сервер слушает внешний адрес
+            token = request.headers.get('X-Broadcast-Token', '')
+            if not broadcast_token or not hmac.compare_digest(token, broadcast_token):
+                return jsonify({'error': 'X-Broadcast-Token header does not match BROADCAST_TOKEN'}), 403
+            return await func(*args, **kwargs)
+        return inner
+    return decorator
+
+
+@app.after_serving
+async def drain_rollbar():
+    await rollbar_reporter.drain()
+    await redis.close()
+
 
 @app.route('/')
 async def index():
@@ -37,6 +72,61 @@ async def update_config_params(name):
     return jsonify(True)
 
 
+@app.route('/funnel')
+@anotify_rollbar()
+async def get_funnel():
+    # ?day=2022-02-14&days=7 - отчеты за 7 дней, заканчивая указанным днем
+    try:
+        last_day = datetime.date.fromisoformat(request.args.get('day') or FunnelRecorder.get_day())
+        days = min(int(request.args.get('days', 1)), 366)
+    except ValueError:
+        return jsonify({'error': 'day must be YYYY-MM-DD, days must be a number'}), 400
+    reports = [
+        await funnel_recorder.get_report((last_day - datetime.timedelta(days=offset)).isoformat())
+        for offset in range(days - 1, -1, -1)
+    ]
+    return jsonify(reports)
+
+
+@app.route('/broadcasts', methods=['POST'])
+@anotify_rollbar()
+@require_broadcast_token()
+async def create_broadcast():
+    # {"text": "Розыгрыш начнется в 16:00", "parse_mode": "Markdown"} - рассылка всем зарегистрированным
+    payload = await request.get_json(force=True, silent=True) or {}
+    text = str(payload.get('text', '')).strip()
+    if not text or payload.get('parse_mode') not in (None, '', 'Markdown', 'MarkdownV2', 'HTML'):
+        return jsonify({'error': 'text is required, parse_mode must be Markdown, MarkdownV2 or HTML'}), 400
+    broadcast_id = await broadcast_store.create(text, payload.get('parse_mode'))
+    return jsonify(await broadcast_store.get(broadcast_id)), 201
+
+
+@app.route('/broadcasts')
+@anotify_rollbar()
+@require_broadcast_token()
+async def get_broadcasts():
+    return jsonify(await broadcast_store.list())
+
+
+@app.route('/broadcasts/<broadcast_id>')
+@anotify_rollbar()
+@require_broadcast_token()
+async def get_broadcast(broadcast_id):
+    broadcast = await broadcast_store.get(broadcast_id)
+    if not broadcast:
+        return jsonify({'error': 'broadcast not found'}), 404
+    return jsonify(broadcast)
+
+
+@app.route('/broadcasts/<broadcast_id>/cancel', methods=['POST'])
+@anotify_rollbar()
+@require_broadcast_token()
+async def cancel_broadcast(broadcast_id):
+    if not await broadcast_store.cancel(broadcast_id):
+        return jsonify({'error': 'broadcast is not active'}), 409
+    return jsonify(await broadcast_store.get(broadcast_id))
+
+
 if __name__ == '__main__':
     with suppress(KeyboardInterrupt):
         asyncio.run(app.run_task(host=env.str('SERV_HOST'), port=env.str('SERV_PORT')))
@@ -0,0 +1,288 @@
+"""Local simulator of the 1C http service with injected latency and failures.
+
+Answers every request the bot sends to URL_1C (currentCheck, documentNumber,
+customerInstagram, customerName, customerTelephone and the combined commit
+of DEFERRED_COMMIT mode). Latency distributions, error rates and business
+answers are set by a profile, a scenario changes the profile over time.
+
+    $ python simulator_1c.py --port 8081 --scenario flapping
+    $ URL_1C=http://127.0.0.1:8081/ python main.py
+
+The simulator is also used by loadtest.py.
+"""
+import math
+import time
+import inspect
+import random
+import asyncio
+import argparse
+import itertools
+import uuid
+import yaml
+
+from collections import Counter
+from contextlib import suppress
+from aiohttp import web
+
+DEFAULT_PROFILE = {
+    # Задержка ответа: <сек> или constant:<сек>, uniform:<от>:<до>, normal:<среднее>:<откл>,
+    # lognormal:<медиана>:<sigma>, exponential:<среднее>
+    'latency': 'constant:0.05',
+    'latency_by_operation': {},
+    # Доля запросов, на которые сервис отвечает ошибкой 500
+    'error_rate': 0,
+    # Доля запросов, ответ на которые приходит через `hang` секунд
+    'timeout_rate': 0,
+    'hang': 60,
+    # Доля запросов, на которые сервис закрывает соединение без ответа
+    'disconnect_rate': 0,
+    # Доли отказов по номеру чека
+    'not_found_rate': 0,
+    'no_active_draw_rate': 0,
+    'does_not_match_rate': 0,
+    'participates_rate': 0,
+    # Доля ответов accountUsedToday на аккаунт instagram
+    'account_used_today_rate': 0,
+    'characters': 6,
+}
+
+SCENARIOS = {
+    'healthy': {'phases': [{}]},
+    'slow': {'phases': [{'latency': 'lognormal:1:0.6'}]},
+    'flapping': {
+        'loop': True,
+        'phases': [
+            {'duration': 20},
+            {'duration': 10, 'error_rate': 0.5, 'timeout_rate': 0.2, 'hang': 30},
+        ],
+    },
+    'outage': {
+        'phases': [
+            {'duration': 30},
+            {'duration': 60, 'disconnect_rate': 1},
+            {'latency': 'lognormal:0.5:0.8'},
+        ],
+    },
+    'business_errors': {
+        'phases': [{
+            'not_found_rate': 0.1,
+            'no_active_draw_rate': 0.02,
+            'does_not_match_rate': 0.03,
+            'participates_rate': 0.05,
+            'account_used_today_rate': 0.05,
+        }],
+    },
+}
+
+DOCUMENT_ANSWERS = (
+    ('not_found_rate', 'not found'),
+    ('no_active_draw_rate', 'no active draw found'),
+    ('does_not_match_rate', 'does not match'),
+    ('participates_rate', 'participates'),
+)
+
+
+def get_operation(payload):
+    """Name of the 1C operation for the request payload."""
+    operations = [key for key in (
+        'currentCheck', 'documentNumber', 'customerInstagram', 'customerName', 'customerTelephone'
+    ) if key in payload]
+    if len(operations) > 1:
+        return 'commit'
+    return operations[0] if operations else 'unknown'
+
+
+def parse_latency(spec, rnd=random):
+    """Return a function generating delays in seconds for the latency spec.
+
+    A bare number is a constant delay.
+    """
+    name, *params = str(spec).split(':')
+    if not params:
+        with suppress(ValueError):
+            name, params = 'constant', [float(name)]
+    params = [float(param) for param in params]
+    distributions = {
+        'constant': lambda value: value,
+        'uniform': rnd.uniform,
+        'normal': lambda mean, deviation: max(0, rnd.gauss(mean, deviation)),
+        'lognormal': lambda median, sigma: rnd.lognormvariate(math.log(median), sigma),
+        'exponential': lambda mean: rnd.expovariate(1 / mean),
+    }
+    if name not in distributions:
+        raise ValueError(f'Unknown latency distribution: {spec}')
+    try:
+        inspect.signature(distributions[name]).bind(*params)
+    except TypeError:
+        raise ValueError(f'Wrong number of latency parameters: {spec}')
+    return lambda: distributions[name](*params)
+
+
+def latency_spec(spec):
+    """argparse type checking the latency spec at startup."""
+    try:
+        parse_latency(spec)
+    except ValueError as error:
+        raise argparse.ArgumentTypeError(str(error))
+    return spec
+
+
+def load_scenario(name_or_path):
+    if name_or_path in SCENARIOS:
+        return SCENARIOS[name_or_path]
+    with open(name_or_path) as f:
+        return yaml.safe_load(f)
+
+
+class Simulator1C:
+    """1C service answering by the current phase of the scenario.
+
+    Documents that got a participant number are answered `participates`
+    afterwards and instagram accounts are reported as used today on the
+    second registration, as the real service does.
+    """
+
+    def __init__(self, profile=None, scenario=None, seed=None):
+        self.profile = {**DEFAULT_PROFILE, **(profile or {})}
+        self.scenario = scenario or SCENARIOS['healthy']
+        self.random = random.Random(seed)
+        self.started_at = time.monotonic()
+        self.participant_numbers = itertools.count(1)
+        self.participated_documents = set()
+        self.used_accounts = set()
+        self.counters = Counter()
+
+    def reset(self):
+        self.started_at = time.monotonic()
+        self.participated_documents.clear()
+        self.used_accounts.clear()
+        self.counters.clear()
+
+    def stats(self):
+        return {f'{operation}.{outcome}': count for (operation, outcome), count in sorted(self.counters.items())}
+
+    def get_profile(self):
+        phases = self.scenario['phases']
+        duration = sum(phase.get('duration', 0) for phase in phases)
+        elapsed = time.monotonic() - self.started_at
+        if self.scenario.get('loop') and duration:
+            elapsed %= duration
+        for phase in phases:
+            if 'duration' not in phase or elapsed < phase['duration']:
+                break
+            elapsed -= phase['duration']
+        overrides = {key: value for key, value in phase.items() if key != 'duration'}
+        return {**self.profile, **overrides}
+
+    def get_latency(self, profile, operation):
+        spec = profile['latency_by_operation'].get(operation, profile['latency'])
+        return parse_latency(spec, self.random)()
+
+    def get_failure(self, profile):
+        chance = self.random.random()
+        for failure in ('disconnect', 'timeout', 'error'):
+            chance -= profile[f'{failure}_rate']
+            if chance < 0:
+                return failure
+
+    @staticmethod
+    def get_document_id(document_number):
+        return uuid.uuid5(uuid.NAMESPACE_OID, document_number).hex
+
+    def get_document_answer(self, profile, document_number):
+        if self.get_document_id(document_number) in self.participated_documents:
+            return 'participates'
+        chance = self.random.random()
+        for rate, answer in DOCUMENT_ANSWERS:
+            chance -= profile[rate]
+            if chance < 0:
+                return answer
+
+    def is_account_used_today(self, profile, instagram):
+        return instagram.lower() in self.used_accounts or self.random.random() < profile['account_used_today_rate']
+
+    def get_reply(self, profile, operation, payload):
+        if operation == 'currentCheck':
+            return {'characters': profile['characters']}
+        if operation == 'documentNumber':
+            answer = self.get_document_answer(profile, payload['documentNumber'])
+            if answer:
+                return {'document': answer}
+            return {'document': self.get_document_id(payload['documentNumber']), 'draw': 'draw-1'}
+
+        reply = {}
+        if 'customerInstagram' in payload:
+            reply['accountUsedToday'] = self.is_account_used_today(profile, payload['customerInstagram'])
+            if reply['accountUsedToday'] and operation == 'commit':
+                return reply
+        if 'customerTelephone' in payload:
+            reply['number'] = next(self.participant_numbers)
+            self.participated_documents.add(payload.get('document'))
+        if operation in ('customerInstagram', 'commit') and 'customerInstagram' in payload:
+            self.used_accounts.add(payload['customerInstagram'].lower())
+        return reply
+
+    async def handle(self, request):
+        payload = await request.json()
+        operation = get_operation(payload)
+        profile = self.get_profile()
+        failure = self.get_failure(profile)
+        await asyncio.sleep(self.get_latency(profile, operation))
+
+        if failure == 'disconnect':
+            self.counters[operation, 'disconnect'] += 1
+            request.transport.close()
+            return web.Response()
+        if failure == 'timeout':
+            self.counters[operation, 'timeout'] += 1
+            await asyncio.sleep(profile['hang'])
+        elif failure == 'error':
+            self.counters[operation, 'error'] += 1
+            raise web.HTTPInternalServerError(text='Simulated 1C error')
+
+        reply = self.get_reply(profile, operation, payload)
+        outcome = reply.get('document') if reply.get('document') in dict(DOCUMENT_ANSWERS).values() else 'ok'
+        if reply.get('accountUsedToday'):
+            outcome = 'account used today'
+        self.counters[operation, outcome] += 1
+        return web.json_response(reply)
+
+    async def handle_stats(self, request):
+        return web.json_response(self.stats())
+
+    def create_app(self):
+        app = web.Application()
+        app.router.add_post('/', self.handle)
+        app.router.add_get('/stats', self.handle_stats)
+        return app
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Симулятор http сервиса 1С.')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8081)
+    parser.add_argument('--scenario', default='healthy', help=f'{", ".join(SCENARIOS)} или путь к yaml файлу')
+    parser.add_argument('--latency', type=latency_spec, default=DEFAULT_PROFILE['latency'], help='распределение задержки ответа')
+    parser.add_argument('--error-rate', type=float, default=0, help='доля ответов с ошибкой 500')
+    parser.add_argument('--timeout-rate', type=float, default=0, help='доля зависших запросов')
+    parser.add_argument('--disconnect-rate', type=float, default=0, help='доля разорванных соединений')
+    parser.add_argument('--characters', type=int, default=DEFAULT_PROFILE['characters'], help='длина номера чека')
+    parser.add_argument('--seed', type=int, default=None)
+    args = parser.parse_args()
+
+    simulator = Simulator1C(
+        {
+            'latency': args.latency,
+            'error_rate': args.error_rate,
+            'timeout_rate': args.timeout_rate,
+            'disconnect_rate': args.disconnect_rate,
+            'characters': args.characters,
+        },
+        scenario=load_scenario(args.scenario),
+        seed=args.seed
+    )
+    web.run_app(simulator.create_app(), host=args.host, port=args.port)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,8 +1,25 @@
 import asks
+import json
+import time
+import uuid
+import asyncio
+import logging
 import functools
 
+from collections import defaultdict
 from contextlib import suppress
+from environs import Env
 from custom_exceptions import SmsApiError
+from notify_rollbar import report_exc_info
+from metrics_lib import track_dependency
+from scheduler_lib import DelayedQueue
+
+env = Env()
+env.read_env()
+
+logger = logging.getLogger('cmstore-bot')
+
+sms_api_url = env.str('SMS_API_URL', 'https://sms.ru/sms')
 
 
 async def request_sms(method, api_id='', payload={}, login='', password=''):
@@ -14,6 +31,7 @@ async def request_sms(method, api_id='', payload={}, login='', password=''):
         login (str): Login for account on SMS.ru. Optional.
         password (str): Password for account on SMS.ru. Optional.
         payload (dict): Additional request params, override default ones.
+            Params are sent as a POST form, so long `multi` payloads fit.
     Returns:
         dict: Response from SMS.ru API.
     Raises:
@@ -26,7 +44,7 @@ async def request_sms(method, api_id='', payload={}, login='', password=''):
         {'status': "OK", 'status_code': 103, 'status_text': "Сообщение доставлено"}
     """
 
-    url = f'https://sms.ru/sms/{method}'
+    url = f'{sms_api_url}/{method}'
     if api_id:
         params = {
             'api_id': api_id
@@ -37,8 +55,9 @@ async def request_sms(method, api_id='', payload={}, login='', password=''):
             'password': password,
         }
     with suppress(asks.errors.BadStatus):
-        responce = await asks.get(url, params={**params, **payload})
-        responce.raise_for_status()
+        async with track_dependency('sms', method):
+            responce = await asks.post(url, data={**params, **payload})
+            responce.raise_for_status()
         reply = responce.json()
         if not reply.get('error'):
             return reply
@@ -46,52 +65,295 @@ async def request_sms(method, api_id='', payload={}, login='', password=''):
     raise SmsApiError(responce.text)
 
 
+async def request_dispatch(api_id, payload):
+    """Send request to the `send` method, a reply that is not json is returned as empty.
+
+    sms.ru may have accepted such a request already, so it must not be repeated.
+    """
+    try:
+        return await request_sms("send", api_id, {**payload, 'json': 1})
+    except ValueError as error:
+        logger.error(f'Ответ sms.ru на отправку не разобран: {error}')
+        return {}
+
+
+def get_dispatch_reports(dispatch_report, phones):
+    """One report per phone, a phone missing in the reply is reported as failed."""
+    dispatch_reports = []
+    for phone in phones:
+        try:
+            phone_report = dispatch_report['sms'][phone]
+            dispatch_reports.append({
+                'phone': phone,
+                'status_code': phone_report['status_code'],
+                'sms_id': phone_report.get('sms_id')
+            })
+        except (KeyError, TypeError):
+            dispatch_reports.append({
+                'phone': phone, 'status_code': None, 'sms_id': None, 'status_text': 'Нет ответа sms.ru по номеру'
+            })
+    return dispatch_reports
+
+
 async def send_sms(api_id, phones, text_message):
 
-    dispatch_report = await request_sms(
-        "send", api_id,
-        {'to': ','.join(phones), 'msg': text_message, 'json': 1}
+    dispatch_report = await request_dispatch(api_id, {'to': ','.join(phones), 'msg': text_message})
+    return get_dispatch_reports(dispatch_report, phones)
+
+
+async def send_multi_sms(api_id, messages):
+    """Send different texts to different phones with one request.
+
+    Args:
+        messages (dict): Text of the message for every phone.
+    """
+
+    dispatch_report = await request_dispatch(
+        api_id, {f'multi[{phone}]': text_message for phone, text_message in messages.items()}
     )
-    return [{
-        'phone': phone,
-        'status_code': dispatch_report['sms'][phone]['status_code'],
-        'sms_id': dispatch_report['sms'][phone]['sms_id']
-    } for phone in phones]
+    return get_dispatch_reports(dispatch_report, messages)
 
 
-async def check_sms_delivery(api_id, dispatch_reports):
+async def check_sms_delivery(api_id, dispatch_reports, batch_size=100, concurrency=4):
+    """Check delivery status of sent messages.
+
+    Statuses are requested for up to `batch_size` sms_ids at once, requests
+    for larger lists run with at most `concurrency` requests in flight.
+    Returns one report per dispatch report, in the same order.
+    """
+
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def request_statuses(sms_ids):
+        async with semaphore:
+            sms_delivery_report = await request_sms(
+                "status", api_id, {'sms_id': ','.join(sms_ids), 'json': 1}
+            )
+        return sms_delivery_report['sms']
+
+    sms_ids = list(dict.fromkeys(str(dispatch_report['sms_id']) for dispatch_report in dispatch_reports))
+    statuses = {}
+    for batch_statuses in await asyncio.gather(*[
+        request_statuses(sms_ids[index:index + batch_size]) for index in range(0, len(sms_ids), batch_size)
+    ]):
+        statuses.update(batch_statuses)
+
     sms_delivery_reports = []
     for dispatch_report in dispatch_reports:
-        sms_id = dispatch_report['sms_id']
-        sms_delivery_report = await request_sms(
-            "status", api_id, {'sms_id': sms_id, 'json': 1}
-        )
+        sms_status = statuses[str(dispatch_report['sms_id'])]
         sms_delivery_reports.append({
             'phone': dispatch_report['phone'],
-            'status': sms_delivery_report['sms'][sms_id]['status'],
-            'status_code': sms_delivery_report['sms'][sms_id]['status_code'],
-            'status_text': sms_delivery_report['sms'][sms_id]['status_text']
+            'status': sms_status['status'],
+            'status_code': sms_status['status_code'],
+            'status_text': sms_status.get('status_text')
         })
     return sms_delivery_reports
 
 
+def report_sms_failure(failed_reports):
+    logger.error(f'Ошибки отправки sms: {failed_reports}')
+    try:
+        raise SmsApiError(str(failed_reports))
+    except SmsApiError:
+        report_exc_info()
+
+
+class SmsDispatcher:
+    """Sends SMS and checks their delivery in background.
+
+    Messages to send are kept in the `sms:outbox` DelayedQueue. `run_sender`
+    collects them for `send_window` seconds and sends identical texts with one
+    multi-recipient request and different texts with one `multi` request.
+    Ids of sent messages are kept in Redis with chat ids of registrations and
+    checked by `run_poller` with exponential backoff until sms.ru reports a
+    final status.
+    """
+
+    def __init__(self, redis, api_id, send_attempts=3, send_window=1, max_batch_size=100,
+                 first_check_delay=15, max_check_delay=600, max_checks=10, batch_size=50,
+                 poll_interval=1):
+        self.redis = redis
+        self.api_id = api_id
+        self.send_attempts = send_attempts
+        self.send_window = send_window
+        self.max_batch_size = max_batch_size
+        self.first_check_delay = first_check_delay
+        self.max_check_delay = max_check_delay
+        self.max_checks = max_checks
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self.outbox = DelayedQueue(redis, 'sms:outbox')
+        self.delivery = DelayedQueue(redis, 'sms:delivery')
+        self.messages_key = 'sms:messages'
+
+    def get_check_delay(self, check_number):
+        return min(self.first_check_delay * 2 ** check_number, self.max_check_delay)
+
+    async def enqueue(self, phone, text, chat_id=None):
+        job = {'id': uuid.uuid4().hex, 'phone': phone, 'text': text, 'chat_id': chat_id, 'attempt': 0}
+        await self.outbox.schedule([json.dumps(job)], time.time())
+
+    def group_jobs(self, jobs):
+        """Split jobs into sms.ru requests: (jobs, send coroutine factory)."""
+        jobs_by_text = defaultdict(list)
+        for job in jobs:
+            jobs_by_text[job['text']].append(job)
+
+        requests = []
+        multi_chunks = []
+        for text_message, text_jobs in jobs_by_text.items():
+            phones = list(dict.fromkeys(job['phone'] for job in text_jobs))
+            if len(phones) > 1:
+                requests.append((text_jobs, functools.partial(send_sms, self.api_id, phones, text_message)))
+                continue
+            # В одном multi запросе телефон может встретиться только один раз
+            for chunk in multi_chunks:
+                if len(chunk) < self.max_batch_size and phones[0] not in chunk:
+                    chunk[phones[0]] = text_jobs
+                    break
+            else:
+                multi_chunks.append({phones[0]: text_jobs})
+
+        for chunk in multi_chunks:
+            chunk_jobs = [job for phone_jobs in chunk.values() for job in phone_jobs]
+            if len(chunk) == 1:
+                phone, phone_jobs = next(iter(chunk.items()))
+                requests.append((chunk_jobs, functools.partial(send_sms, self.api_id, [phone], phone_jobs[0]['text'])))
+            else:
+                messages = {phone: phone_jobs[0]['text'] for phone, phone_jobs in chunk.items()}
+                requests.append((chunk_jobs, functools.partial(send_multi_sms, self.api_id, messages)))
+        return requests
+
+    async def send(self, jobs, send):
+        try:
+            dispatch_reports = await send()
+        # повторяются только запросы, которые sms.ru не принял, иначе sms придут дважды
+        except (SmsApiError, asks.errors.ConnectivityError, OSError) as error:
+            for job in jobs:
+                job['attempt'] += 1
+                if job['attempt'] < self.send_attempts:
+                    await self.outbox.schedule([json.dumps(job)], time.time() + self.get_check_delay(job['attempt']))
+                else:
+                    report_sms_failure([{'phone': job['phone'], 'error': str(error)}])
+            return
+
+        chat_ids = {job['phone']: job['chat_id'] for job in jobs}
+        failed_reports = [report for report in dispatch_reports if report['status_code'] != 100]
+        if failed_reports:
+            report_sms_failure(failed_reports)
+        sent_messages = {
+            str(report['sms_id']): json.dumps({
+                'phone': report['phone'], 'chat_id': chat_ids.get(report['phone']), 'check': 0
+            })
+            for report in dispatch_reports if report['status_code'] == 100
+        }
+        if not sent_messages:
+            return
+        try:
+            await self.redis.hset(self.messages_key, mapping=sent_messages)
+            await self.delivery.schedule(sent_messages, time.time() + self.get_check_delay(0))
+        except Exception as error:
+            # sms уже приняты sms.ru, поэтому задачи подтверждаются и без проверки доставки
+            logger.error(f'Не удалось сохранить отправленные sms для проверки доставки: {error}')
+            report_exc_info()
+
+    async def run_sender(self):
+        while True:
+            try:
+                # Сообщения копятся в очереди в течение окна и отправляются минимальным числом запросов
+                await asyncio.sleep(self.send_window)
+                members = await self.outbox.claim(self.max_batch_size)
+                if not members:
+                    continue
+                members_by_id = {}
+                for member in members:
+                    job = json.loads(member)
+                    members_by_id[job['id']] = (member, job)
+                requests = self.group_jobs([job for _, job in members_by_id.values()])
+                results = await asyncio.gather(
+                    *[self.send(request_jobs, send) for request_jobs, send in requests], return_exceptions=True
+                )
+                # подтверждаются только обработанные запросы, остальные вернутся в очередь после аренды
+                await self.outbox.ack([
+                    members_by_id[job['id']][0]
+                    for (request_jobs, _), result in zip(requests, results)
+                    if not isinstance(result, BaseException) for job in request_jobs
+                ])
+                errors = [result for result in results if isinstance(result, BaseException)]
+                if errors:
+                    raise errors[0]
+            except asyncio.CancelledError:
+                raise
+            except Exception as error:
+                logger.error(f'Ошибка отправки sms: {error}')
+                report_exc_info()
+                await asyncio.sleep(self.poll_interval)
+
+    async def check(self, sms_ids):
+        raw_messages = await self.redis.hmget(self.messages_key, sms_ids)
+        messages = {
+            sms_id: json.loads(raw_message) for sms_id, raw_message in zip(sms_ids, raw_messages) if raw_message
+        }
+        finished = [sms_id for sms_id in sms_ids if sms_id not in messages]
+        if not messages:
+            return finished
+
+        try:
+            sms_delivery_reports = await check_sms_delivery(self.api_id, [
+                {'phone': message['phone'], 'sms_id': sms_id} for sms_id, message in messages.items()
+            ])
+        except (SmsApiError, KeyError, asks.errors.ConnectivityError, OSError) as error:
+            logger.error(f'Ошибка проверки доставки sms: {error}')
+            sms_delivery_reports = [{'phone': message['phone'], 'status_code': None} for message in messages.values()]
+
+        failed_reports = []
+        for (sms_id, message), sms_delivery_report in zip(messages.items(), sms_delivery_reports):
+            status_code = sms_delivery_report['status_code']
+            if status_code is not None and (status_code >= 103 or status_code == -1):
+                if status_code != 103:
+                    failed_reports.append(sms_delivery_report)
+                finished.append(sms_id)
+                continue
+            message['check'] += 1
+            if message['check'] >= self.max_checks:
+                failed_reports.append({**sms_delivery_report, 'status_text': 'Не дождались окончательного статуса'})
+                finished.append(sms_id)
+                continue
+            await self.redis.hset(self.messages_key, sms_id, json.dumps(message))
+            await self.delivery.schedule([sms_id], time.time() + self.get_check_delay(message['check']))
+
+        if failed_reports:
+            report_sms_failure(failed_reports)
+        if finished:
+            await self.redis.hdel(self.messages_key, *finished)
+        return finished
+
+    async def run_poller(self):
+        while True:
+            try:
+                sms_ids = await self.delivery.claim(self.batch_size)
+                if not sms_ids:
+                    await asyncio.sleep(self.poll_interval)
+                    continue
+                finished = await self.check(sms_ids)
+                await self.delivery.ack(finished)
+            except asyncio.CancelledError:
+                raise
+            except Exception as error:
+                logger.error(f'Ошибка проверки доставки sms: {error}')
+                report_exc_info()
+                await asyncio.sleep(self.poll_interval)
+
+
 def handle_sms():
     def decorator(func):
         @functools.wraps(func)
         async def inner(*args, **kwargs):
             with suppress(TypeError, ValueError, KeyError):
                 user_data, final_text = await func(*args, **kwargs)
-                api_id = args[0].bot.data['sms_api_id']
-                dispatch_reports = await send_sms(
-                    api_id, [user_data['phone_number']], final_text
-                )
-                sms_delivery_reports = await check_sms_delivery(api_id, dispatch_reports)
-                unsuccessful_sms_delivery = [
-                    sms_delivery_report for sms_delivery_report in sms_delivery_reports if (
-                        sms_delivery_report['status_code'] >= 104 or sms_delivery_report['status_code'] == -1
-                    )
-                ]
-                if unsuccessful_sms_delivery:
-                    raise SmsApiError(unsuccessful_sms_delivery)
+                # Отправка и проверка доставки выполняются в фоне, ответ пользователю их не ждёт
+                sms_dispatcher = args[0].bot.data['sms_dispatcher']
+                if sms_dispatcher:
+                    await sms_dispatcher.enqueue(user_data['phone_number'], final_text, args[0].chat.id)
         return inner
     return decorator
@@ -0,0 +1,457 @@
+"""FSM storages: CompactRedisStorage keeps state, data and bucket of a chat
+in one Redis hash, CachedStorage serves repeated reads of any storage from memory.
+
+    $ python storage_lib.py migrate
+
+moves conversations from RedisStorage2 keys to the hash storage at once,
+otherwise they are moved on the first read.
+"""
+import copy
+import json
+import time
+import asyncio
+import logging
+import argparse
+import aioredis
+
+from collections import OrderedDict
+from contextlib import suppress
+from contextvars import ContextVar
+from environs import Env
+from aiogram.dispatcher.storage import BaseStorage
+
+logger = logging.getLogger('cmstore-bot')
+
+STATE_FIELD = 's'
+DATA_FIELD_PREFIX = 'd:'
+# данные, перенесенные из RedisStorage2 одной строкой json
+LEGACY_DATA_FIELD = 'j'
+BUCKET_FIELD = 'b'
+
+# версия диалогов чата, прочитанная вместе с блокировкой чата: (чат, версия)
+locked_chat_version = ContextVar('locked_chat_version', default=None)
+
+# Возвращает хеш чата и продлевает его срок. Если хеша нет, переносит в него ключи RedisStorage2.
+# KEYS: хеш чата, ключи состояния, данных и bucket RedisStorage2. ARGV: ttl, переносить ли ключи.
+GET_SCRIPT = '''
+local fields = redis.call('HGETALL', KEYS[1])
+if #fields == 0 and ARGV[2] == '1' then
+    local state = redis.call('GET', KEYS[2])
+    local data = redis.call('GET', KEYS[3])
+    local bucket = redis.call('GET', KEYS[4])
+    if state or data or bucket then
+        if state then redis.call('HSET', KEYS[1], 's', state) end
+        if data then redis.call('HSET', KEYS[1], 'j', data) end
+        if bucket then redis.call('HSET', KEYS[1], 'b', bucket) end
+        redis.call('DEL', KEYS[2], KEYS[3], KEYS[4])
+        fields = redis.call('HGETALL', KEYS[1])
+    end
+end
+if #fields > 0 then
+    redis.call('EXPIRE', KEYS[1], ARGV[1])
+end
+return fields
+'''
+
+# Заменяет данные чата, bucket не меняется. ARGV: ttl, удалять ли состояние, затем пары поле, значение.
+SET_DATA_SCRIPT = '''
+local fields = redis.call('HKEYS', KEYS[1])
+for _, field in ipairs(fields) do
+    if field == 'j' or string.sub(field, 1, 2) == 'd:' or (field == 's' and ARGV[2] == '1') then
+        redis.call('HDEL', KEYS[1], field)
+    end
+end
+for i = 3, #ARGV, 2 do
+    redis.call('HSET', KEYS[1], ARGV[i], ARGV[i + 1])
+end
+if redis.call('EXISTS', KEYS[1]) == 1 then
+    redis.call('EXPIRE', KEYS[1], ARGV[1])
+end
+return 1
+'''
+
+
+def encode_value(value):
+    return json.dumps(value, ensure_ascii=False, separators=(',', ':'))
+
+
+class CompactRedisStorage(BaseStorage):
+    """Keeps FSM state, data and bucket of a chat in one Redis hash.
+
+    Every data key is a separate hash field, so update_data writes only the
+    changed keys without reading the data first, and every operation is one
+    request to Redis. Each request extends the hash lifetime to `ttl`
+    seconds, conversations abandoned for longer expire. Keys of RedisStorage2
+    with `legacy_prefix` are moved into the hash when the chat is read.
+    """
+
+    def __init__(self, redis, prefix='conversation', ttl=24 * 60 * 60, legacy_prefix='fsm'):
+        self.redis = redis
+        self.prefix = prefix
+        self.ttl = ttl
+        self.legacy_prefix = legacy_prefix
+
+    async def close(self):
+        # соединение с Redis общее с ботом и закрывается в on_shutdown
+        pass
+
+    async def wait_closed(self):
+        pass
+
+    def get_key(self, chat, user):
+        return f'{self.prefix}:{chat}:{user}'
+
+    def get_legacy_keys(self, chat, user):
+        return [f'{self.legacy_prefix}:{chat}:{user}:{name}' for name in ('state', 'data', 'bucket')]
+
+    async def get_fields(self, chat, user):
+        chat, user = self.check_address(chat=chat, user=user)
+        values = await self.redis.eval(
+            GET_SCRIPT, 4, self.get_key(chat, user), *self.get_legacy_keys(chat, user),
+            self.ttl, 1 if self.legacy_prefix else 0
+        )
+        return dict(zip(values[::2], values[1::2]))
+
+    @staticmethod
+    def decode_data(fields):
+        data = json.loads(fields[LEGACY_DATA_FIELD]) if LEGACY_DATA_FIELD in fields else {}
+        data.update(
+            (field[len(DATA_FIELD_PREFIX):], json.loads(value))
+            for field, value in fields.items() if field.startswith(DATA_FIELD_PREFIX)
+        )
+        return data
+
+    async def write_fields(self, chat, user, fields=None, deleted_fields=()):
+        key = self.get_key(*self.check_address(chat=chat, user=user))
+        async with self.redis.pipeline(transaction=True) as pipe:
+            if deleted_fields:
+                pipe.hdel(key, *deleted_fields)
+            if fields:
+                pipe.hset(key, mapping=fields)
+            pipe.expire(key, self.ttl)
+            await pipe.execute()
+
+    async def get_state(self, *, chat=None, user=None, default=None):
+        fields = await self.get_fields(chat, user)
+        return fields.get(STATE_FIELD) or self.resolve_state(default)
+
+    async def get_data(self, *, chat=None, user=None, default=None):
+        fields = await self.get_fields(chat, user)
+        return self.decode_data(fields) or default or {}
+
+    async def set_state(self, *, chat=None, user=None, state=None):
+        if state is None:
+            await self.write_fields(chat, user, deleted_fields=[STATE_FIELD])
+        else:
+            await self.write_fields(chat, user, {STATE_FIELD: self.resolve_state(state)})
+
+    async def set_data(self, *, chat=None, user=None, data=None):
+        chat, user = self.check_address(chat=chat, user=user)
+        fields = [
+            item for key, value in (data or {}).items() for item in (f'{DATA_FIELD_PREFIX}{key}', encode_value(value))
+        ]
+        await self.redis.eval(SET_DATA_SCRIPT, 1, self.get_key(chat, user), self.ttl, 0, *fields)
+
+    async def update_data(self, *, chat=None, user=None, data=None, **kwargs):
+        data = {**(data or {}), **kwargs}
+        if data:
+            await self.write_fields(
+                chat, user, {f'{DATA_FIELD_PREFIX}{key}': encode_value(value) for key, value in data.items()}
+            )
+
+    async def set_state_and_data(self, *, chat=None, user=None, state=None, data=None):
+        """Set the state and update data keys in one transaction."""
+        fields = {f'{DATA_FIELD_PREFIX}{key}': encode_value(value) for key, value in (data or {}).items()}
+        if state is None:
+            await self.write_fields(chat, user, fields, deleted_fields=[STATE_FIELD])
+        else:
+            await self.write_fields(chat, user, {**fields, STATE_FIELD: self.resolve_state(state)})
+
+    async def reset_state(self, *, chat=None, user=None, with_data=True):
+        if with_data:
+            # bucket остается, как в RedisStorage2
+            chat, user = self.check_address(chat=chat, user=user)
+            await self.redis.eval(SET_DATA_SCRIPT, 1, self.get_key(chat, user), self.ttl, 1)
+        else:
+            await self.set_state(chat=chat, user=user, state=None)
+
+    async def finish(self, *, chat=None, user=None):
+        await self.reset_state(chat=chat, user=user, with_data=True)
+
+    def has_bucket(self):
+        return True
+
+    async def get_bucket(self, *, chat=None, user=None, default=None):
+        fields = await self.get_fields(chat, user)
+        if BUCKET_FIELD in fields:
+            return json.loads(fields[BUCKET_FIELD])
+        return default or {}
+
+    async def set_bucket(self, *, chat=None, user=None, bucket=None):
+        if bucket:
+            await self.write_fields(chat, user, {BUCKET_FIELD: encode_value(bucket)})
+        else:
+            await self.write_fields(chat, user, deleted_fields=[BUCKET_FIELD])
+
+    async def update_bucket(self, *, chat=None, user=None, bucket=None, **kwargs):
+        bucket = {**(await self.get_bucket(chat=chat, user=user)), **(bucket or {}), **kwargs}
+        await self.set_bucket(chat=chat, user=user, bucket=bucket)
+
+    async def reset_all(self, full=True):
+        async for key in self.redis.scan_iter(match=f'{self.prefix}:*'):
+            await self.redis.delete(key)
+
+    async def get_states_list(self):
+        states = []
+        async for key in self.redis.scan_iter(match=f'{self.prefix}:*'):
+            *_, chat, user = key.split(':')
+            states.append((chat, user))
+        return states
+
+    async def migrate_legacy_keys(self):
+        """Move all conversations stored by RedisStorage2 into hashes."""
+        chats = set()
+        for name in ('state', 'data', 'bucket'):
+            async for key in self.redis.scan_iter(match=f'{self.legacy_prefix}:*:*:{name}', count=1000):
+                *_, chat, user, _ = key.split(':')
+                chats.add((chat, user))
+        for chat, user in chats:
+            await self.get_fields(chat, user)
+        return len(chats)
+
+
+async def set_state_and_data(storage, *, chat=None, user=None, state=None, data=None):
+    """Update data keys and set the state, with one request if the storage supports it."""
+    if hasattr(storage, 'set_state_and_data'):
+        await storage.set_state_and_data(chat=chat, user=user, state=state, data=data)
+    else:
+        await storage.update_data(chat=chat, user=user, data=data)
+        await storage.set_state(chat=chat, user=user, state=state)
+
+
+class CachedStorage(BaseStorage):
+    """In-process LRU cache of state, data and bucket in front of another FSM storage.
+
+    Writes go to the storage and then update the cache. When `redis` is
+    given, every write first increments the version of the chat in Redis
+    and a cached value is served only while its version is current, so
+    a write of another bot process is never missed. ChatLockMiddleware reads
+    the version in the same request that takes the chat lock, then hits need
+    no Redis requests; without the lock the version is read on every access.
+    Entries also expire after `local_ttl` seconds.
+    """
+
+    def __init__(self, storage, redis=None, max_size=10000, local_ttl=60, version_prefix='fsm:version',
+                 version_ttl=24 * 60 * 60):
+        self.storage = storage
+        self.redis = redis
+        self.max_size = max_size
+        self.local_ttl = local_ttl
+        self.version_prefix = version_prefix
+        self.version_ttl = version_ttl
+        self.entries = OrderedDict()
+        # номер изменения кэша, чтобы ответ хранилища, полученный во время записи, не затер новое значение
+        self.generation = 0
+        self.counters = {'hits': 0, 'misses': 0, 'invalidations': 0}
+
+    def stats(self):
+        return {**self.counters, 'local_size': len(self.entries)}
+
+    def clear(self):
+        self.entries.clear()
+        self.generation += 1
+
+    async def close(self):
+        await self.storage.close()
+
+    async def wait_closed(self):
+        await self.storage.wait_closed()
+
+    def get_version_key(self, chat):
+        return f'{self.version_prefix}:{chat}'
+
+    def set_locked_version(self, chat, version):
+        """Remember the chat version read together with the chat lock for the current update."""
+        return locked_chat_version.set((str(chat), version or '0'))
+
+    def reset_locked_version(self, token):
+        locked_chat_version.reset(token)
+
+    async def get_version(self, key):
+        if not self.redis:
+            return None
+        locked_version = locked_chat_version.get()
+        if locked_version and locked_version[0] == key[0]:
+            return locked_version[1]
+        return await self.redis.get(self.get_version_key(key[0])) or '0'
+
+    async def increment_version(self, key):
+        # версия меняется до записи, чтобы при сбое записи другие процессы не поверили старому кэшу
+        self.generation += 1
+        if not self.redis:
+            return None
+        version_key = self.get_version_key(key[0])
+        async with self.redis.pipeline(transaction=True) as pipe:
+            version, _ = await pipe.incr(version_key).expire(version_key, self.version_ttl).execute()
+        version = str(version)
+        locked_version = locked_chat_version.get()
+        if locked_version and locked_version[0] == key[0]:
+            locked_chat_version.set((key[0], version))
+        return version
+
+    def get_cache_key(self, chat, user):
+        chat, user = self.check_address(chat=chat, user=user)
+        return str(chat), str(user)
+
+    def get_entry(self, key, version):
+        """Cached values of the chat if they are still current, otherwise None."""
+        with suppress(KeyError):
+            expires_at, entry_version, entry = self.entries[key]
+            if expires_at > time.monotonic():
+                if entry_version == version:
+                    return entry
+                self.counters['invalidations'] += 1
+            del self.entries[key]
+        return None
+
+    async def get_cached(self, chat, user, name, load):
+        key = self.get_cache_key(chat, user)
+        version = await self.get_version(key)
+        entry = self.get_entry(key, version)
+        if entry is not None and name in entry:
+            self.entries.move_to_end(key)
+            self.counters['hits'] += 1
+            return copy.deepcopy(entry[name])
+        self.counters['misses'] += 1
+        generation = self.generation
+        value = await load()
+        if generation == self.generation:
+            self.update_entry(key, version, {**(entry or {}), name: value})
+        return copy.deepcopy(value)
+
+    def update_entry(self, key, version, entry):
+        self.entries[key] = (time.monotonic() + self.local_ttl, version, copy.deepcopy(entry))
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    async def write(self, chat, user, write, update):
+        """Write through to the storage, `update` changes the cached values in place."""
+        key = self.get_cache_key(chat, user)
+        entry = self.get_entry(key, await self.get_version(key))
+        self.entries.pop(key, None)
+        version = await self.increment_version(key)
+        await write()
+        entry = dict(entry or {})
+        update(entry)
+        self.update_entry(key, version, entry)
+
+    async def get_state(self, *, chat=None, user=None, default=None):
+        state = await self.get_cached(
+            chat, user, 'state', lambda: self.storage.get_state(chat=chat, user=user)
+        )
+        return state or self.resolve_state(default)
+
+    async def get_data(self, *, chat=None, user=None, default=None):
+        data = await self.get_cached(
+            chat, user, 'data', lambda: self.storage.get_data(chat=chat, user=user)
+        )
+        return data or default or {}
+
+    async def set_state(self, *, chat=None, user=None, state=None):
+        await self.write(
+            chat, user,
+            lambda: self.storage.set_state(chat=chat, user=user, state=state),
+            lambda entry: entry.update(state=self.resolve_state(state))
+        )
+
+    async def set_data(self, *, chat=None, user=None, data=None):
+        await self.write(
+            chat, user,
+            lambda: self.storage.set_data(chat=chat, user=user, data=data),
+            lambda entry: entry.update(data=data or {})
+        )
+
+    async def update_data(self, *, chat=None, user=None, data=None, **kwargs):
+        def update(entry):
+            if 'data' in entry:
+                entry['data'] = {**entry['data'], **(data or {}), **kwargs}
+
+        # если данных нет в кэше, их объединение с новыми ключами прочитается из хранилища
+        await self.write(
+            chat, user, lambda: self.storage.update_data(chat=chat, user=user, data=data, **kwargs), update
+        )
+
+    async def set_state_and_data(self, *, chat=None, user=None, state=None, data=None):
+        def update(entry):
+            entry['state'] = self.resolve_state(state)
+            if 'data' in entry:
+                entry['data'] = {**entry['data'], **(data or {})}
+
+        await self.write(
+            chat, user,
+            lambda: set_state_and_data(self.storage, chat=chat, user=user, state=state, data=data),
+            update
+        )
+
+    async def reset_state(self, *, chat=None, user=None, with_data=True):
+        await self.write(
+            chat, user,
+            lambda: self.storage.reset_state(chat=chat, user=user, with_data=with_data),
+            lambda entry: entry.update(state=None, **({'data': {}} if with_data else {}))
+        )
+
+    async def finish(self, *, chat=None, user=None):
+        await self.reset_state(chat=chat, user=user, with_data=True)
+
+    def has_bucket(self):
+        return self.storage.has_bucket()
+
+    async def get_bucket(self, *, chat=None, user=None, default=None):
+        bucket = await self.get_cached(
+            chat, user, 'bucket', lambda: self.storage.get_bucket(chat=chat, user=user)
+        )
+        return bucket or default or {}
+
+    async def set_bucket(self, *, chat=None, user=None, bucket=None):
+        await self.write(
+            chat, user,
+            lambda: self.storage.set_bucket(chat=chat, user=user, bucket=bucket),
+            lambda entry: entry.update(bucket=bucket or {})
+        )
+
+    async def update_bucket(self, *, chat=None, user=None, bucket=None, **kwargs):
+        bucket = {**(await self.get_bucket(chat=chat, user=user)), **(bucket or {}), **kwargs}
+        await self.set_bucket(chat=chat, user=user, bucket=bucket)
+
+    async def reset_all(self, full=True):
+        await self.storage.reset_all(full)
+        self.clear()
+
+    async def get_states_list(self):
+        return await self.storage.get_states_list()
+
+
+async def run_migration():
+    env = Env()
+    env.read_env()
+    redis = aioredis.Redis(
+        host=env.str('REDIS_HOST', 'localhost'),
+        port=env.int('REDIS_PORT', 6379),
+        db=5,
+        decode_responses=True
+    )
+    storage = CompactRedisStorage(redis, ttl=env.int('FSM_TTL', 24 * 60 * 60))
+    print(f'migrated conversations: {await storage.migrate_legacy_keys()}')
+    await redis.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Перенос состояний диалогов из ключей RedisStorage2.')
+    parser.add_argument('command', choices=('migrate',))
+    parser.parse_args()
+    asyncio.run(run_migration())
+
+
+if __name__ == '__main__':
+    main()